@@ -1,14 +1,19 @@
 #!/bin/bash
+# Usage (from the repository root): ./benchmark.sh [benchmark.py options], e.g. ./benchmark.sh --compare bench_baseline.json
+set -e
+
 echo "Navigating to Rust directory..."
-cd "Rust"
-echo "Building Rust project..."
-curl --proto '=https' --tlsv1.2 -sSf https://sh.rustup.rs | sh
-time cargo build --release
+cd "rust"
+if command -v cargo > /dev/null; then
+    echo "Building Rust project..."
+    time cargo build --release
+else
+    echo "cargo not found, skipping the Rust build (see https://rustup.rs)."
+fi
 
 echo "Navigating back to parent directory..."
 cd ..
 
-echo "Navigating to Python directory..."
-cd "Python"
-echo "Running Python script..."
-time python3 your_python_script.py
\ No newline at end of file
+# Run from the root so --compare paths resolve against it; results go where `make benchmark` puts them
+echo "Running Python benchmarks..."
+python3 python/src/benchmark.py --output python/benchmark.json "$@"
@@ -1,6 +1,11 @@
+import time
+
 import utils as util
+from bpeTrainer import BPETrainer
+from instrumentation import logger, phase
+from tokenizer import Tokenizer
 
-class BasicTokenizer:
+class BasicTokenizer(Tokenizer):
     def __init__(self) -> None:
         pass
         
@@ -10,70 +15,105 @@ class BasicTokenizer:
         if len(text) == 0:
             raise ValueError("[Thoth => train]: String empty. Nothing to train on.")
 
-        print("[Thoth => train]: Training...")
+        logger.info("[Thoth => train]: Training...")
         self.mints = {} # (int, int) -> int
         self.vocab = {idx: bytes([idx]) for idx in range(256)}
-        print(self.vocab)
         
         tokens = text.encode('utf-8')
         encodedIntegers = [byte for byte in tokens]
 
-        commonTuples = util.countCommonEncodedTuples(encodedIntegers)
-        sortedCommonTuples = sorted(((v, k) for k, v in commonTuples.items()), reverse=True) 
-        self.minter(sortedCommonTuples, encodedIntegers, 256, vocabSize)
-        print("[Thoth => train]: Training complete.")
+        self.trainMerges([encodedIntegers], None, vocabSize)
+        logger.info("[Thoth => train]: Training complete.")
+
+    def trainStream(self, sources, vocabSize: int, maxUniqueChunks: int = None, pieceSize: int = util.CORPUS_PIECE_SIZE, numWorkers: int = None) -> None:
+        """Description: Trains the tokenizer on a corpus stream (paths, files, str lines, or byte chunks read as one stream; see `utils.corpusSources`), one unique line at a time (pairs never span lines)"""
+        assert(vocabSize >= 256)
+        with phase(self.metrics, "train.count"):
+            lineCounts = util.countStreamChunks(sources, util.LINE_SPLIT_PATTERN, maxUniqueChunks=maxUniqueChunks, pieceSize=pieceSize, numWorkers=numWorkers)
+        if len(lineCounts) == 0:
+            raise ValueError("[Thoth => train]: Stream empty. Nothing to train on.")
+
+        logger.info("[Thoth => train]: Training on %d unique lines...", len(lineCounts))
+        self.vocab = {idx: bytes([idx]) for idx in range(256)}
+        self.trainMerges([list(line) for line in lineCounts], list(lineCounts.values()), vocabSize)
+        logger.info("[Thoth => train]: Training complete.")
 
-    def encoder(self, text: str) -> list[int]:
-        """Description: Encodes input text to a compressed sequence of integers """
+    def encoder(self, text: str, outputType: str = "list") -> list[int]:
+        """Description: Encodes input text to a compressed sequence of integers (returned as a list, array, memoryview or NumPy array per `outputType`)"""
         if len(text) == 0:
             raise ValueError("[Thoth => encoder]: String empty. Nothing to encode.")
         
-        print("[Thoth => encoder]: Encoding...")
+        metrics = self.metrics
+        started = time.perf_counter() if metrics is not None else 0.0
         tokens = text.encode("utf-8")
-        encodedIntegers = [byte for byte in tokens]
+        encodedIntegers = util.applyMerges(tokens, self.mints)
+        if metrics is not None:
+            self.recordCall("encode", started, len(encodedIntegers), len(tokens))
+        return util.packIds(encodedIntegers, outputType, self.getFlatVocab().size)
 
-        while len(encodedIntegers) >= 2:
-            commonTuples = util.countCommonEncodedTuples(encodedIntegers)
-            pair = min(commonTuples, key=lambda p: self.mints.get(p, float("inf")))
-            if pair not in self.mints:
-                break
-            idx = self.mints[pair]
-            encodedIntegers = util.merge(pair, encodedIntegers, idx)
-        print("[Thoth => encoder]: Encoding Complete...")
-        return encodedIntegers
+    def encodeStream(self, source, pieceSize: int = util.CORPUS_PIECE_SIZE):
+        """
+        - Encodes an unbounded text stream (a path, file object, or iterable of str / bytes pieces), yielding token ids as soon as they are settled.
+        - A merge can never cross two adjacent bytes that do not occur next to each other inside any vocab entry, so everything before the last such position is encoded and yielded; only the BPE tail after it is held back.
+        - Yields the same ids as `encoder` on the concatenated text.
+
+        Parameters:
+        - source: A path, file object, str, or iterable of str / bytes pieces (see `utils.readCorpus`).
+        - pieceSize (int): Read size for paths and file objects.
+
+        Returns:
+        - Generator of token ids.
+        """
+        joinable = self.joinableBytePairs()
+        tail = b""
+        for piece in util.readCorpus(source, pieceSize):
+            buffer = tail + piece.encode("utf-8")
+            # Positions inside the old tail were already checked, so only scan the new bytes (and the seam), from the right
+            cut = 0
+            for i in range(len(buffer) - 1, max(len(tail), 1) - 1, -1):
+                if buffer[i - 1:i + 1] not in joinable:
+                    cut = i
+                    break
+            if cut:
+                yield from util.applyMerges(buffer[:cut], self.mints)
+                tail = buffer[cut:]
+            else:
+                tail = buffer
+        if tail:
+            yield from util.applyMerges(tail, self.mints)
 
     def decoder(self, ids: list[int]) -> str:
         """Description: Inverse of Encoder -> Converts encoded text into human-readable text input text """
         if len(ids) == 0:
             raise ValueError("[Thoth => decoder]: No IDs. Nothing to decode.")
         
-        print("[Thoth => decoder]: Decoding...")
-        textBytes = b"".join(self.vocab[idx] for idx in ids)
-        print("[Thoth => decoder]: Decoding Complete...")
+        metrics = self.metrics
+        started = time.perf_counter() if metrics is not None else 0.0
+        textBytes = self.getFlatVocab().gather(ids)
+        if metrics is not None:
+            self.recordCall("decode", started, len(ids), len(textBytes))
         return textBytes.decode("utf-8", errors="replace")
 
     ########################################################
     ################### HELPER FUNCTIONS ###################
     ########################################################
     
-    def mintToken(self, dictTuples: list[tuple], ids: list[int], idx: int) -> None:
-        """Description: Replaces the most common tuple with a new integer token (created by the tokenizer)"""
-        _, mostCommonPairOfInts  = dictTuples.pop(0)
-        print(f"[Thoth => minter]: Minting {mostCommonPairOfInts} into a new token {idx}")
-        self.mints[mostCommonPairOfInts] = idx
-        self.vocab[idx] = self.vocab[mostCommonPairOfInts[0]] + self.vocab[mostCommonPairOfInts[1]]
-        i = 0 
-        while i < len(ids) - 1:
-            if ids[i] == mostCommonPairOfInts[0] and ids[i + 1] == mostCommonPairOfInts[1]:
-                ids[i:i + 2] = [idx]
-                i -= 1
-            i += 1
-    
-    def minter(self, sortedDictTuples, idsList: list[int], startIndex: int, endIndex: int):
-        """Description: Iteratively replaces common tuples with new integer tokens (minting)"""
-        while (startIndex < endIndex): # tuneable parameter
-            self.mintToken(sortedDictTuples, idsList, startIndex)
-            startIndex += 1
+    def trainMerges(self, chunks: list[list[int]], counts: list[int], vocabSize: int) -> None:
+        """Description: Learns `vocabSize` - 256 merges over byte chunks (weighted by `counts` if given), timed as the "train.merge" phase"""
+        with phase(self.metrics, "train.merge"):
+            trainer = BPETrainer(chunks, counts)
+            self.mints = trainer.train(vocabSize - 256, 256, callback=self.mintToken)
+        if self.metrics is not None:
+            self.metrics.count("train.merges", len(self.mints))
+
+    def joinableBytePairs(self) -> set[bytes]:
+        """Description: Returns every pair of adjacent bytes found inside a vocab entry (the positions BPE may still merge across)"""
+        return {token[i:i + 2] for token in self.vocab.values() for i in range(len(token) - 1)}
+
+    def mintToken(self, pair: tuple[int, int], idx: int, count: int) -> None:
+        """Description: Registers the bytes of a newly minted token (called by the trainer after every merge)"""
+        logger.debug("[Thoth => minter]: Minting %s into a new token %d", pair, idx)
+        self.vocab[idx] = self.vocab[pair[0]] + self.vocab[pair[1]]
 
 if __name__ == "__main__":
     BasicTokenizerInstance = BasicTokenizer()
@@ -83,7 +123,7 @@ if __name__ == "__main__":
     sampleText = "Ｕｎｉｃｏｄｅ! 🅤🅝🅘🅒🅞🅓🅔‽ 🇺‌🇳‌🇮‌🇨‌🇴‌🇩‌🇪! 😄 The very name strikes fear and awe into the hearts of programmers worldwide. We all know we ought to “support Unicode” in our software (whatever that means—like using wchar_t for all the strings, right?). But Unicode can be abstruse, and diving into the thousand-page Unicode Standard plus its dozens of supplementary annexes, reports, and notes can be more than a little intimidating. I don’t blame programmers for still finding the whole thing mysterious, even 30 years after Unicode’s inception."
     vocabSize = 276
 
-    print("\n" + sampleText + "\n")
+    # print("\n" + sampleText + "\n")
     BasicTokenizerInstance.train(sampleText, vocabSize)
     listOfEncodedIntegers = BasicTokenizerInstance.encoder(fileContent)
     assert(len(listOfEncodedIntegers) > 0)
@@ -0,0 +1,261 @@
+"""Benchmark harness: trains / encodes / decodes every tokenizer over real and synthetic corpora and writes the measurements as JSON."""
+
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+TOKENIZERS = ("BasicTokenizer", "RegexTokenizer", "GPT4Tokenizer", "Llama2Tokenizer")
+TOKENIZER_MODULES = {"BasicTokenizer": "basicTokenizer", "RegexTokenizer": "regexTokenizer", "GPT4Tokenizer": "gpt4Tokenizer", "Llama2Tokenizer": "llama2Tokenizer"}
+CORPORA = ("taylorSwift", "code", "cjk", "whitespace", "emoji")
+DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "data", "taylorSwift.txt")
+# Metrics compared by --compare, and whether higher values are better
+COMPARED_METRICS = {"trainSecondsPerMerge": False, "encodeMBps": True, "encodeWarmMBps": True, "decodeMBps": True, "latencyP50Ms": False, "latencyP99Ms": False,
+                    "latencyWarmP50Ms": False, "latencyWarmP99Ms": False, "peakRssMB": False, "compressionRatio": True}
+
+########################################################
+####################### CORPORA ########################
+########################################################
+
+def buildCorpus(name: str, numChars: int, seed: int = 0) -> str:
+    """Description: Returns the named corpus: data/taylorSwift.txt, or a deterministic synthetic corpus of about `numChars` characters"""
+    if name == "taylorSwift":
+        with open(DATA_PATH, "r", encoding="utf-8") as f:
+            return f.read()
+    rng = random.Random(seed)
+    makeLine = {"code": codeLine, "cjk": cjkLine, "whitespace": whitespaceLine, "emoji": emojiLine}[name]
+    lines, size = [], 0
+    while size < numChars:
+        line = makeLine(rng)
+        lines.append(line)
+        size += len(line)
+    return "".join(lines)
+
+def codeLine(rng: random.Random) -> str:
+    """Description: One line of Python-like source code"""
+    names = ["self", "ids", "pair", "idx", "vocab", "merges", "text", "count", "result", "buffer"]
+    indent = "    " * rng.randint(0, 3)
+    kind = rng.random()
+    if kind < 0.3:
+        return f"{indent}{rng.choice(names)} = {rng.choice(names)}.get(({rng.choice(names)}, {rng.randint(0, 999)}), {rng.randint(0, 9)})\n"
+    if kind < 0.5:
+        return f"{indent}for {rng.choice(names)} in range(len({rng.choice(names)}) - {rng.randint(1, 3)}):\n"
+    if kind < 0.7:
+        return f"{indent}if {rng.choice(names)}[{rng.randint(0, 9)}] != {rng.choice(names)} and not {rng.choice(names)}:\n"
+    if kind < 0.85:
+        return f"{indent}# {' '.join(rng.choice(names) for _ in range(rng.randint(2, 8)))}\n"
+    return f"{indent}return {rng.choice(names)}({', '.join(rng.choice(names) for _ in range(rng.randint(0, 3)))})\n"
+
+def cjkLine(rng: random.Random) -> str:
+    """Description: One line of CJK text with punctuation (mostly common characters, some rare ones)"""
+    common = [chr(0x4E00 + i * 7) for i in range(400)] + [chr(0x3041 + i) for i in range(80)] + [chr(0xAC00 + i * 31) for i in range(100)]
+    chars = [rng.choice(common) if rng.random() < 0.95 else chr(rng.randint(0x4E00, 0x9FFF)) for _ in range(rng.randint(10, 60))]
+    return "".join(chars) + rng.choice(["。", "、", "！", "？"]) + "\n"
+
+def whitespaceLine(rng: random.Random) -> str:
+    """Description: One line with long runs of spaces, tabs and blank lines between short words"""
+    parts = []
+    for _ in range(rng.randint(1, 6)):
+        parts.append(rng.choice([" ", "\t", "  "]) * rng.randint(1, 40))
+        parts.append(rng.choice(["x", "id", "value", "|", "--"]))
+    return "".join(parts) + "\n" * rng.randint(1, 4)
+
+def emojiLine(rng: random.Random) -> str:
+    """Description: One chat-style line mixing words, emoji, ZWJ sequences and flags"""
+    emoji = [chr(0x1F600 + i) for i in range(80)] + ["👍🏽", "👩‍💻", "🇨🇦", "🏳️‍🌈", "❤️"]
+    words = ["lol", "ok", "great", "see", "you", "soon", "thanks"]
+    return " ".join(rng.choice(emoji) if rng.random() < 0.5 else rng.choice(words) for _ in range(rng.randint(3, 15))) + "\n"
+
+def splitDocuments(text: str, docChars: int) -> list[str]:
+    """Description: Splits a corpus into documents of about `docChars` characters, cut after a newline where possible"""
+    documents, start = [], 0
+    while start < len(text):
+        end = min(len(text), start + docChars)
+        newline = text.rfind("\n", start, end)
+        if end < len(text) and newline > start:
+            end = newline + 1
+        documents.append(text[start:end])
+        start = end
+    return documents
+
+########################################################
+###################### MEASUREMENT #####################
+########################################################
+
+def peakRssMB() -> float:
+    """Description: Returns the peak resident set size of this process in MB (ru_maxrss is in KB on Linux, bytes on macOS)"""
+    maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxRss / (1 << 20) if sys.platform == "darwin" else maxRss / (1 << 10)
+
+def percentile(values: list[float], q: float) -> float:
+    """Description: Returns the `q` (0-100) percentile of `values` (nearest rank)"""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+def resetCache(tokenizer) -> None:
+    """Description: Empties the tokenizer's chunk / word cache, if it has one, so the next measurement starts cold"""
+    cache = getattr(tokenizer, "chunkCache", None) or getattr(tokenizer, "wordCache", None)
+    if cache is not None:
+        cache.clear()
+
+def timeDocuments(tokenizer, documents: list[str]) -> list[float]:
+    """Description: Returns the encode latency of every document in milliseconds"""
+    latencies = []
+    for document in documents:
+        start = time.perf_counter()
+        tokenizer.encoder(document)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+def runCase(tokenizerName: str, corpusName: str, vocabSize: int, corpusChars: int, docChars: int, maxDocs: int) -> dict:
+    """
+    - Measures one tokenizer on one corpus (meant to run in a fresh process, so the peak RSS belongs to this case alone).
+    - Trains (except GPT4Tokenizer, which is pretrained), then encodes and decodes the whole corpus and encodes it again document by document.
+    - Encoding is measured twice, each time on the whole corpus and per document: cold (chunk / word cache emptied first) and warm (right after, with the cache filled by the cold pass).
+
+    Returns:
+    - dict: One result record (see `main`), or a record with an "error" field if the tokenizer could not be built.
+    """
+    import importlib
+    record = {"tokenizer": tokenizerName, "corpus": corpusName}
+    text = buildCorpus(corpusName, corpusChars)
+    corpusBytes = len(text.encode("utf-8"))
+    record["corpusBytes"] = corpusBytes
+    tokenizerClass = getattr(importlib.import_module(TOKENIZER_MODULES[tokenizerName]), tokenizerName)
+    try:
+        tokenizer = tokenizerClass()
+    except Exception as e: # e.g. GPT4Tokenizer without ranks on an offline host
+        record["error"] = f"{type(e).__name__}: {e}"
+        return record
+
+    if tokenizerName == "GPT4Tokenizer":
+        record.update(vocabSize=len(tokenizer.mints) + 256, trainSeconds=None, numMerges=len(tokenizer.mints), trainSecondsPerMerge=None)
+    else:
+        start = time.perf_counter()
+        tokenizer.train(text, vocabSize)
+        trainSeconds = time.perf_counter() - start
+        numMerges = len(tokenizer.merges if tokenizerName == "Llama2Tokenizer" else tokenizer.mints)
+        record.update(vocabSize=vocabSize, trainSeconds=trainSeconds, numMerges=numMerges, trainSecondsPerMerge=trainSeconds / numMerges if numMerges else None)
+
+    resetCache(tokenizer)
+    start = time.perf_counter()
+    ids = tokenizer.encoder(text)
+    encodeSeconds = time.perf_counter() - start
+    start = time.perf_counter()
+    tokenizer.encoder(text)
+    encodeWarmSeconds = time.perf_counter() - start
+    start = time.perf_counter()
+    decoded = tokenizer.decoder(ids)
+    decodeSeconds = time.perf_counter() - start
+
+    documents = splitDocuments(text, docChars)[:maxDocs]
+    resetCache(tokenizer)
+    latencies = timeDocuments(tokenizer, documents)
+    warmLatencies = timeDocuments(tokenizer, documents)
+
+    record.update(
+        numTokens=len(ids),
+        encodeMBps=corpusBytes / 1e6 / encodeSeconds,
+        encodeWarmMBps=corpusBytes / 1e6 / encodeWarmSeconds,
+        decodeMBps=corpusBytes / 1e6 / decodeSeconds,
+        latencyP50Ms=percentile(latencies, 50),
+        latencyP99Ms=percentile(latencies, 99),
+        latencyWarmP50Ms=percentile(warmLatencies, 50),
+        latencyWarmP99Ms=percentile(warmLatencies, 99),
+        numDocuments=len(latencies),
+        compressionRatio=corpusBytes / len(ids),
+        roundTrip=decoded == text,
+        peakRssMB=peakRssMB(),
+    )
+    return record
+
+def compareResults(results: list[dict], baseline: dict, tolerance: float) -> list[str]:
+    """Description: Returns a description of every metric that got worse than the baseline run by more than `tolerance` (a fraction)"""
+    previous = {(r["tokenizer"], r["corpus"]): r for r in baseline["results"]}
+    regressions = []
+    for record in results:
+        old = previous.get((record["tokenizer"], record["corpus"]))
+        if old is None or "error" in record or "error" in old:
+            continue
+        for metric, higherIsBetter in COMPARED_METRICS.items():
+            new, before = record.get(metric), old.get(metric)
+            if not new or not before:
+                continue
+            change = (new - before) / before
+            if (-change if higherIsBetter else change) > tolerance:
+                regressions.append(f"{record['tokenizer']}/{record['corpus']} {metric}: {before:.4g} -> {new:.4g} ({change:+.1%})")
+        if old.get("roundTrip") and not record.get("roundTrip"):
+            regressions.append(f"{record['tokenizer']}/{record['corpus']} no longer round-trips")
+    return regressions
+
+def printTable(results: list[dict]) -> None:
+    """Description: Prints the results as a fixed-width table"""
+    def fmt(value, spec):
+        return "-" if value is None else format(value, spec)
+    print(f"{'tokenizer':<16}{'corpus':<12}{'s/merge':>10}{'enc MB/s':>10}{'warm':>8}{'dec MB/s':>10}{'p50 ms':>9}{'p99 ms':>9}{'warm p99':>9}{'RSS MB':>9}{'ratio':>7}  ok")
+    for r in results:
+        if "error" in r:
+            print(f"{r['tokenizer']:<16}{r['corpus']:<12}skipped: {r['error']}")
+            continue
+        print(f"{r['tokenizer']:<16}{r['corpus']:<12}{fmt(r['trainSecondsPerMerge'], '10.5f')}{r['encodeMBps']:10.2f}{r['encodeWarmMBps']:8.2f}{r['decodeMBps']:10.2f}"
+              f"{r['latencyP50Ms']:9.3f}{r['latencyP99Ms']:9.3f}{r['latencyWarmP99Ms']:9.3f}{r['peakRssMB']:9.1f}{r['compressionRatio']:7.2f}  {'yes' if r['roundTrip'] else 'NO'}")
+
+def main(argv: list[str] = None) -> int:
+    """
+    - Runs every (tokenizer, corpus) case, each in a fresh worker process unless --in-process is given, prints a table and writes the results to --output as JSON.
+    - With --compare, exits with status 1 if any metric regressed past --tolerance against that earlier output.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the Thoth tokenizers.")
+    parser.add_argument("--tokenizers", nargs="+", choices=TOKENIZERS, default=list(TOKENIZERS))
+    parser.add_argument("--corpora", nargs="+", choices=CORPORA, default=list(CORPORA))
+    parser.add_argument("--vocab-size", type=int, default=512, help="vocab size to train to (GPT4Tokenizer is pretrained)")
+    parser.add_argument("--corpus-chars", type=int, default=200_000, help="size of each synthetic corpus")
+    parser.add_argument("--doc-chars", type=int, default=1000, help="document size for the per-document latency")
+    parser.add_argument("--max-docs", type=int, default=500, help="number of documents timed for the latency percentiles")
+    parser.add_argument("--output", default="benchmark.json", help="JSON file the results are written to")
+    parser.add_argument("--compare", help="earlier JSON output to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative slowdown before --compare reports a regression")
+    parser.add_argument("--in-process", action="store_true", help="run every case in this process (peak RSS is then cumulative)")
+    args = parser.parse_args(argv)
+
+    results = []
+    for tokenizerName in args.tokenizers:
+        for corpusName in args.corpora:
+            caseArgs = (tokenizerName, corpusName, args.vocab_size, args.corpus_chars, args.doc_chars, args.max_docs)
+            if args.in_process:
+                results.append(runCase(*caseArgs))
+                continue
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+                results.append(pool.submit(runCase, *caseArgs).result())
+
+    printTable(results)
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "arguments": vars(args),
+        },
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            regressions = compareResults(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"[Thoth => benchmark]: Regression: {regression}")
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
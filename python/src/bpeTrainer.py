@@ -0,0 +1,119 @@
+"""Incremental Byte Pair Encoding (BPE) training engine shared by the tokenizers."""
+
+import heapq
+
+import utils as util
+
+class BPETrainer:
+    """
+    - Learns BPE merges over a collection of chunks (lists of integer ids) without recounting the corpus per merge.
+    - Keeps a live pair -> count index and a pair -> positions index over doubly linked chunks (built in one vectorized pass when NumPy is available, see `utils.indexPairs`).
+    - Picks the next pair from a lazily invalidated max-heap: stale entries are skipped (or re-pushed) when popped.
+    - Only the neighbours of each merged occurrence are touched, so a merge costs O(occurrences * log(pairs)).
+    - Produces exactly the same merges as recounting from scratch each step: highest count wins, ties go to the smallest pair.
+    """
+
+    def __init__(self, chunks: list[list[int]], chunkCounts: list[int] = None) -> None:
+        # Flatten every chunk into shared arrays; links never cross chunk boundaries
+        self.ids, self.prev, self.next, self.weight = [], [], [], []
+        chunkCounts = [1] * len(chunks) if chunkCounts is None else chunkCounts
+        for chunk, count in zip(chunks, chunkCounts):
+            start = len(self.ids)
+            n = len(chunk)
+            self.ids.extend(chunk)
+            self.prev.extend(range(start - 1, start + n - 1))
+            self.next.extend(range(start + 1, start + n + 1))
+            self.weight.extend([count] * n)
+            if n > 0:
+                self.prev[start] = -1
+                self.next[start + n - 1] = -1
+
+        # (int, int) -> weighted frequency, and (int, int) -> set of left positions (may hold stale entries)
+        self.pairCounts, self.pairPositions = util.indexPairs(self.ids, self.next, self.weight)
+        self.heap = [(-count, pair) for pair, count in self.pairCounts.items()]
+        heapq.heapify(self.heap)
+
+    def train(self, numOfMerges: int, startIndex: int = 256, callback=None) -> dict[tuple[int, int], int]:
+        """Description: Mints up to `numOfMerges` new tokens and returns the merges as (int, int) -> int"""
+        mints = {}
+        for idx in range(startIndex, startIndex + numOfMerges):
+            pair = self.popMostCommonPair()
+            if pair is None:
+                break # every chunk collapsed into a single token
+            count = self.pairCounts[pair]
+            self.mergePair(pair, idx)
+            mints[pair] = idx
+            if callback is not None:
+                callback(pair, idx, count)
+        return mints
+
+    ########################################################
+    ################### HELPER FUNCTIONS ###################
+    ########################################################
+
+    def addPair(self, pair: tuple[int, int], pos: int, weight: int) -> None:
+        """Description: Records one occurrence of a pair starting at `pos`"""
+        self.pairCounts[pair] = self.pairCounts.get(pair, 0) + weight
+        self.pairPositions.setdefault(pair, set()).add(pos)
+
+    def removePair(self, pair: tuple[int, int], weight: int) -> None:
+        """Description: Forgets one occurrence of a pair (its position entry is invalidated lazily)"""
+        count = self.pairCounts[pair] - weight
+        if count > 0:
+            self.pairCounts[pair] = count
+        else:
+            del self.pairCounts[pair]
+            del self.pairPositions[pair]
+
+    def popMostCommonPair(self):
+        """Description: Pops the highest count pair off the heap, skipping entries invalidated by earlier merges"""
+        while self.heap:
+            negCount, pair = heapq.heappop(self.heap)
+            count = self.pairCounts.get(pair, 0)
+            if count == -negCount:
+                return pair
+            if 0 < count < -negCount:
+                # Count went down since this entry was pushed; increases push their own entry
+                heapq.heappush(self.heap, (-count, pair))
+        return None
+
+    def mergePair(self, pair: tuple[int, int], idx: int) -> None:
+        """Description: Replaces every (left to right, non-overlapping) occurrence of `pair` with `idx`"""
+        ids, prev, nxt, weight = self.ids, self.prev, self.next, self.weight
+        first, second = pair
+        touched = set()
+        for pos in sorted(self.pairPositions[pair]):
+            # Skip positions that an earlier merge in this pass (or a previous one) consumed
+            right = nxt[pos]
+            if ids[pos] != first or right == -1 or ids[right] != second:
+                continue
+            w = weight[pos]
+            left, after = prev[pos], nxt[right]
+            if left != -1:
+                self.removePair((ids[left], first), w)
+            self.removePair(pair, w)
+            if after != -1:
+                self.removePair((second, ids[after]), w)
+
+            # Unlink the right node and relabel the left one
+            ids[pos] = idx
+            ids[right] = -1
+            nxt[pos] = after
+            if after != -1:
+                prev[after] = pos
+
+            if left != -1:
+                newPair = (ids[left], idx)
+                self.addPair(newPair, left, w)
+                touched.add(newPair)
+            if after != -1:
+                newPair = (idx, ids[after])
+                self.addPair(newPair, pos, w)
+                touched.add(newPair)
+
+        self.pairCounts.pop(pair, None)
+        self.pairPositions.pop(pair, None)
+        # Push the final count of every pair this merge created (older heap entries go stale)
+        for newPair in touched:
+            if newPair in self.pairCounts:
+                heapq.heappush(self.heap, (-self.pairCounts[newPair], newPair))
@@ -1,8 +1,21 @@
 """Implements GPT-4 Tokenizer as wrapper around RegexTokenizer."""
 
-import tiktoken
+import base64
+import hashlib
+import heapq
+import os
+from array import array
+
+import utils as util
+from instrumentation import logger
+from modelFile import MODEL_FILE_MAGIC, readModelFile, writeModelFile
 from regexTokenizer import RegexTokenizer
 
+try:
+    import tiktoken
+except ImportError: # tiktoken is optional when a local ranks file is given
+    tiktoken = None
+
 def bpe(mergeableRanks, token, maxRank):
     """
     - Implements Byte Pair Encoding (BPE) algorithm to reconstruct the merge forest for a given token.
@@ -18,21 +31,34 @@ def bpe(mergeableRanks, token, maxRank):
     Returns:
     - list: A list of parts, where each part is a byte or a merged byte sequence.
     """
-    # Helper function used in getGpt4Merges() to reconstruct the merge forest
+    # Helper function used in recoverMerges() to reconstruct the merge forest.
+    # Parts live in a linked list and candidate merges in a (rank, position) min-heap, so every merge only re-ranks its two new neighbours.
     parts = [bytes([b]) for b in token]
-    while True:
-        minIdx = None
-        minRank = None
-        for i, pair in enumerate(zip(parts[:-1], parts[1:])):
-            rank = mergeableRanks.get(pair[0] + pair[1])
-            if rank is not None and (minRank is None or rank < minRank):
-                minIdx = i
-                minRank = rank
-        if minRank is None or (maxRank is not None and minRank >= maxRank):
-            break
-        assert minIdx is not None
-        parts = parts[:minIdx] + [parts[minIdx] + parts[minIdx + 1]] + parts[minIdx + 2:]
-    return parts
+    nxt = list(range(1, len(parts))) + [-1]
+    prev = list(range(-1, len(parts) - 1))
+
+    def rankOf(i, j):
+        rank = mergeableRanks.get(parts[i] + parts[j])
+        return rank if rank is not None and (maxRank is None or rank < maxRank) else None
+
+    heap = [(rank, i) for i in range(len(parts) - 1) if (rank := rankOf(i, i + 1)) is not None]
+    heapq.heapify(heap)
+    while heap:
+        rank, i = heapq.heappop(heap)
+        j = nxt[i]
+        # Skip entries whose pair was changed by an earlier merge
+        if j == -1 or parts[i] is None or rankOf(i, j) != rank:
+            continue
+        parts[i], parts[j] = parts[i] + parts[j], None
+        k = nxt[j]
+        nxt[i] = k
+        if k != -1:
+            prev[k] = i
+            if (newRank := rankOf(i, k)) is not None:
+                heapq.heappush(heap, (newRank, i))
+        if prev[i] != -1 and (newRank := rankOf(prev[i], i)) is not None:
+            heapq.heappush(heap, (newRank, prev[i]))
+    return [part for part in parts if part is not None]
 
 def recoverMerges(mergeableRanks):
     """
@@ -51,7 +77,7 @@ def recoverMerges(mergeableRanks):
     # Do a small BPE training run on all the tokens, in their order.
     # Refs: https://github.com/openai/tiktoken/issues/60 & https://github.com/karpathy/minbpe/issues/11#issuecomment-1950805306
     merges = {}
-    for token, rank in mergeableRanks.items():
+    for token, rank in sorted(mergeableRanks.items(), key=lambda item: item[1]):
         if len(token) == 1:
             # Skip raw bytes
             continue
@@ -64,6 +90,101 @@ def recoverMerges(mergeableRanks):
 
     return merges
 
+CL100K_BASE_SHA256 = "223921b76ee99bde995b7ff738513eef100fb51d18c93597a113bcffe865b2a7" # of the official cl100k_base.tiktoken
+
+def loadTiktokenRanks(path: str, expectedHash: str = None) -> dict[bytes, int]:
+    """
+    - Reads a `.tiktoken` ranks file (one "<base64 token> <rank>" line per token) into a bytes -> rank dict, as tiktoken does, without tiktoken or network access.
+    - The file is parsed line by line while its SHA-256 is computed, so it is never held in memory as a whole.
+
+    Parameters:
+    - path (str): The path to the `.tiktoken` file.
+    - expectedHash (str, optional): Hex SHA-256 the file must have (e.g. `CL100K_BASE_SHA256`).
+
+    Returns:
+    - dict: A dictionary mapping token bytes to their merge ranks.
+    """
+    hasher = hashlib.sha256()
+    mergeableRanks = {}
+    with open(path, "rb") as f:
+        for lineNumber, line in enumerate(f, 1):
+            hasher.update(line)
+            if not line.strip():
+                continue
+            try:
+                token, rank = line.split()
+                mergeableRanks[base64.b64decode(token, validate=True)] = int(rank)
+            except ValueError as e:
+                raise ValueError(f"[Thoth => loadTiktokenRanks]: Malformed line {lineNumber} in {path}: {line!r}") from e
+    if expectedHash is not None and hasher.hexdigest() != expectedHash:
+        raise ValueError(f"[Thoth => loadTiktokenRanks]: {path} has SHA-256 {hasher.hexdigest()}, expected {expectedHash}.")
+    return mergeableRanks
+
+def saveCompactRanks(mergeableRanks: dict[bytes, int], path: str, sourceHash: str = None) -> None:
+    """
+    - Saves ranks in the compact binary form read by `loadCompactRanks`: tokens in rank order in one blob, an offsets array, the ranks, and a SHA-256 digest of all three.
+    - `sourceHash` records the SHA-256 of the `.tiktoken` file the ranks came from, so the converted file can be checked against the same expected hash.
+    """
+    items = sorted(mergeableRanks.items(), key=lambda item: item[1])
+    blob = b"".join(token for token, _ in items)
+    offsets = array("Q", [0])
+    for token, _ in items:
+        offsets.append(offsets[-1] + len(token))
+    ranks = array("I", (rank for _, rank in items))
+    digest = hashlib.sha256(bytes(ranks) + bytes(offsets) + blob).digest()
+    writeModelFile(path, {
+        "rankBlob": blob,
+        "rankOffsets": offsets,
+        "ranks": ranks,
+        "digest": digest,
+        "sourceSha256": bytes.fromhex(sourceHash) if sourceHash else b"",
+    })
+
+def loadCompactRanks(path: str, expectedHash: str = None) -> dict[bytes, int]:
+    """
+    - Loads ranks written by `saveCompactRanks`, verifying their digest (and, if given, that they were converted from a file with SHA-256 `expectedHash`).
+    - Much faster than parsing base64 text, and usable without tiktoken or network access.
+    """
+    _, sections = readModelFile(path)
+    try:
+        blob, offsets, ranks = sections["rankBlob"], sections["rankOffsets"].cast("Q"), sections["ranks"].cast("I")
+        digest, sourceHash = bytes(sections["digest"]), bytes(sections["sourceSha256"]).hex()
+    except KeyError as e:
+        raise ValueError(f"[Thoth => loadCompactRanks]: {path} is missing section {e}.") from None
+    if hashlib.sha256(bytes(sections["ranks"]) + bytes(sections["rankOffsets"]) + bytes(blob)).digest() != digest:
+        raise ValueError(f"[Thoth => loadCompactRanks]: {path} is corrupt (digest mismatch).")
+    if expectedHash is not None and sourceHash != expectedHash:
+        raise ValueError(f"[Thoth => loadCompactRanks]: {path} was converted from a file with SHA-256 {sourceHash or 'unknown'}, expected {expectedHash}.")
+    return {bytes(blob[offsets[i]:offsets[i + 1]]): ranks[i] for i in range(len(ranks))}
+
+def loadRanks(path: str, expectedHash: str = None) -> dict[bytes, int]:
+    """Description: Loads a ranks file in either the `.tiktoken` text format or the compact binary format"""
+    with open(path, "rb") as f:
+        isCompact = f.read(len(MODEL_FILE_MAGIC)) == MODEL_FILE_MAGIC
+    return loadCompactRanks(path, expectedHash) if isCompact else loadTiktokenRanks(path, expectedHash)
+
+def ranksSourceHash(path: str) -> str:
+    """Description: Returns the SHA-256 `loadRanks` checks a ranks file against: the file's own for `.tiktoken` text, the recorded source hash for compact files (or the compact file's own if none was recorded)"""
+    with open(path, "rb") as f:
+        isCompact = f.read(len(MODEL_FILE_MAGIC)) == MODEL_FILE_MAGIC
+    if isCompact:
+        _, sections = readModelFile(path)
+        sourceHash = bytes(sections["sourceSha256"]).hex() if "sourceSha256" in sections else ""
+        if sourceHash:
+            return sourceHash
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+GPT4_MERGES_CACHE_VERSION = 3 # bump whenever the recovered tables change shape or meaning
+
+def defaultMergesCachePath(encodingName: str = "cl100k_base") -> str:
+    """Description: Returns where the recovered merges are cached: $THOTH_CACHE_DIR, or ~/.cache/thoth"""
+    cacheDir = os.environ.get("THOTH_CACHE_DIR") or os.path.join(os.path.expanduser("~"), ".cache", "thoth")
+    return os.path.join(cacheDir, f"{encodingName}.merges.v{GPT4_MERGES_CACHE_VERSION}.thoth")
+
 GPT4_SPLIT_PATTERN = r"""'(?i:[sdmt]|ll|ve|re)|[^\r\n\p{L}\p{N}]?+\p{L}+|\p{N}{1,3}| ?[^\s\p{L}\p{N}]++[\r\n]*|\s*[\r\n]|\s+(?!\S)|\s+"""
 GPT4_SPECIAL_TOKENS = {
     '<|endoftext|>': 100257,
@@ -76,33 +197,107 @@ GPT4_SPECIAL_TOKENS = {
 class GPT4Tokenizer(RegexTokenizer):
     """Lightweight wrapper on RegexTokenizer that matches GPT-4's tokenizer."""
 
-    def __init__(self):
-        super().__init__(pattern=GPT4_SPLIT_PATTERN)
-        # Get the official tokenizer and its merges
-        try: 
-            enc = tiktoken.getEncoding("cl100k_base")
-        except Exception as e:
-            print(f"[Thoth]: Failed to get encoding with error: {e}")
-            return
-        mergeableRanks = enc._mergeableRanks
+    def __init__(self, cacheSize: int = util.CHUNK_CACHE_SIZE, mergesCachePath: str = None, useMergesCache: bool = True, ranksPath: str = None, ranksHash: str = CL100K_BASE_SHA256):
+        super().__init__(pattern=GPT4_SPLIT_PATTERN, cacheSize=cacheSize)
+        mergesCachePath = defaultMergesCachePath() if mergesCachePath is None else mergesCachePath
+        # Get the official ranks: from a local file if one is configured (air-gapped hosts), else through tiktoken
+        ranksPath = os.environ.get("THOTH_GPT4_RANKS") if ranksPath is None else ranksPath
+        if ranksPath:
+            self.ranksSha256 = ranksSourceHash(ranksPath)
+            if ranksHash is not None and self.ranksSha256 != ranksHash:
+                raise ValueError(f"[Thoth => GPT4Tokenizer]: {ranksPath} has SHA-256 {self.ranksSha256}, expected {ranksHash}.")
+        else:
+            self.ranksSha256 = CL100K_BASE_SHA256 # tiktoken checks its download against the official hash
+        # Recovering the merges replays BPE over every rank, so reuse the tables from an earlier run on the same ranks when possible
+        if useMergesCache and os.path.exists(mergesCachePath):
+            try:
+                self.loadMergesCache(mergesCachePath, self.ranksSha256)
+                self.registerSpecialTokens(GPT4_SPECIAL_TOKENS)
+                return
+            except (OSError, ValueError) as e:
+                logger.warning("[Thoth]: Rebuilding unusable merges cache %s: %s", mergesCachePath, e)
+        if ranksPath:
+            mergeableRanks = loadRanks(ranksPath, ranksHash)
+        elif tiktoken is not None:
+            mergeableRanks = tiktoken.get_encoding("cl100k_base")._mergeable_ranks
+        else:
+            raise RuntimeError("[Thoth => GPT4Tokenizer]: No cl100k_base ranks available: pass ranksPath (or set THOTH_GPT4_RANKS) or install tiktoken.")
         # Recover GPT4 merges
-        self.merges = recoverMerges(mergeableRanks)
-        # Reconstruct the vocab from the merges
-        vocab = {idx: bytes([idx]) for idx in range(256)}
-        for (p0, p1), idx in self.merges.items():
-            vocab[idx] = vocab[p0] + vocab[p1]
-        self.vocab = vocab
+        self.mints = recoverMerges(mergeableRanks)
         # The tokens corresponding to individual bytes are permuted in a different order. 
         self.byteShuffle = {i: mergeableRanks[bytes([i])] for i in range(256)}
         self.inverseByteShuffle = {v: k for k, v in self.byteShuffle.items()}
+        self.compileByteShuffle()
+        # Reconstruct the vocab from the merges, with the permutation undone (each token maps to its original bytes)
+        vocab = {idx: bytes([self.inverseByteShuffle[idx]]) for idx in range(256)}
+        for (p0, p1), idx in self.mints.items():
+            vocab[idx] = vocab[p0] + vocab[p1]
+        self.vocab = vocab
         # Register the special tokens
         self.registerSpecialTokens(GPT4_SPECIAL_TOKENS)
+        if useMergesCache:
+            try:
+                self.saveMergesCache(mergesCachePath)
+            except OSError as e:
+                logger.warning("[Thoth]: Could not write merges cache %s: %s", mergesCachePath, e)
+
+    def saveMergesCache(self, path: str) -> None:
+        """
+        - Saves the recovered `mints`, `vocab` (original bytes) and `byteShuffle` tables (a regular `save`, see `Tokenizer.save`), along with the SHA-256 of the ranks they were recovered from (`ranksSha256`).
+        - Later constructions from the same ranks memory-map this file instead of recovering the merges again.
+
+        Parameters:
+        - path (str): The path to the cache file.
+
+        Returns:
+        - None
+        """
+        self.save(path)
+
+    def loadMergesCache(self, path: str, ranksHash: str = None) -> None:
+        """
+        - Loads the tables written by `saveMergesCache` into this instance.
+        - The vocab stays a view into the memory-mapped file (shared between processes); only the merges dict is rebuilt.
+        - Raises ValueError if `ranksHash` is given and the cache was recovered from other ranks (or does not record which).
+
+        Parameters:
+        - path (str): The path to the cache file.
+        - ranksHash (str, optional): SHA-256 of the ranks the cache must have been recovered from.
+
+        Returns:
+        - None
+        """
+        cached = GPT4Tokenizer.load(path)
+        if ranksHash is not None and cached.ranksSha256 != ranksHash:
+            raise ValueError(f"[Thoth => loadMergesCache]: {path} was recovered from ranks with SHA-256 {cached.ranksSha256 or 'unknown'}, expected {ranksHash}.")
+        self.mints, self.vocab = cached.mints, cached.vocab
+        self.byteShuffle, self.inverseByteShuffle = cached.byteShuffle, cached.inverseByteShuffle
+        self.compileByteShuffle()
+
+    def compileByteShuffle(self) -> None:
+        """Description: Precompiles `byteShuffle` into a `bytes.translate` table, so a chunk is permuted in one C call"""
+        self.shuffleTable = bytes(self.byteShuffle[i] for i in range(256))
+
+    def modelSections(self) -> tuple[dict, dict]:
+        """Description: Adds the byte permutation to the saved RegexTokenizer state"""
+        metadata, sections = super().modelSections()
+        metadata["ranksSha256"] = getattr(self, "ranksSha256", None)
+        sections["byteShuffle"] = array("I", (self.byteShuffle[i] for i in range(256)))
+        return metadata, sections
+
+    def loadSections(self, metadata: dict, sections: dict) -> None:
+        """Description: Restores a saved GPT4Tokenizer"""
+        super().loadSections(metadata, sections)
+        self.ranksSha256 = metadata.get("ranksSha256")
+        self.byteShuffle = dict(enumerate(sections["byteShuffle"].cast("I")))
+        self.inverseByteShuffle = {v: k for k, v in self.byteShuffle.items()}
+        self.compileByteShuffle()
 
     def encodeChunk(self, textBytes):
         """
         - Encodes a chunk of text into a sequence of token IDs using the GPT-4 tokenizer.
         - Permutes bytes of input text before processing them.
-        - Uses `byteShuffle` attribute of the `GPT4Tokenizer` class to reorder bytes according to a specific pattern. 
+        - Uses the `shuffleTable` attribute (precompiled from `byteShuffle`) to reorder bytes according to a specific pattern. 
         - Calls `chunkify` method of the superclass (`RegexTokenizer`) to convert the permuted bytes into a sequence of token IDs.
 
         Parameters:
@@ -112,35 +307,16 @@ class GPT4Tokenizer(RegexTokenizer):
         - list: A list of token IDs representing the encoded input text.
         """
         # Permute bytes before processing them
-        textBytes = bytes(self.byteShuffle[b] for b in textBytes)
-        ids = super().chunkify(textBytes)
+        ids = super().chunkify(textBytes.translate(self.shuffleTable))
         return ids
 
-    def decode(self, ids):
-        """
-        - Decodes a sequence of token IDs back into human-readable text using the GPT-4 tokenizer.
-        - Reverses encoding process un-permuting bytes of the token IDs. 
-        - Uses `inverseByteShuffle` attribute of the `GPT4Tokenizer` class to restore the original byte order. 
-        - Joins bytes into a single byte sequence and decodes it into a string of text.
-
-        Parameters:
-        - ids (list): A list of token IDs representing the encoded input text.
-
-        Returns:
-        - str: The decoded text as a string.
-        """
-
-        # Un-permute the bytes before decoding
-        textBytes = b"".join(self.vocab[idx] for idx in ids)
-        textBytes = bytes(self.inverseByteShuffle[b] for b in textBytes)
-        text = textBytes.decode("utf-8", errors="replace")
-        return text
+    decode = RegexTokenizer.decoder
 
     def saveVocab(self, vocabFile):
         """
         - Saves the vocabulary used by the GPT-4 tokenizer to a file.
-        - Builds the vocabulary, accounting byte shuffle. 
-        - Merges shuffled bytes and writes them to the specified file. 
+        - Renders every token from its original bytes, as stored in the vocab.
+        - Writes every token, with the pair it was merged from, to the specified file.
         - Vocabulary is saved in a format that includes the original byte sequences and their corresponding token IDs, 
 
         Parameters:
@@ -150,23 +326,20 @@ class GPT4Tokenizer(RegexTokenizer):
         - None
         """
 
-        from .utils import renderToken
-        # Build vocab being mindful of the byte shuffle
-        vocab = {idx: bytes([self.inverseByteShuffle[idx]]) for idx in range(256)}
-        for (p0, p1), idx in self.merges.items():
-            vocab[idx] = vocab[p0] + vocab[p1]
-        # Merge the shuffled bytes and write to file
-        invertedMerges = {idx: pair for pair, idx in self.merges.items()}
+        # The vocab already holds the original bytes (the byte shuffle is undone when it is built)
+        vocab = self.vocab
+        # Render every token, with the two tokens it was merged from, and write to file
+        invertedMerges = {idx: pair for pair, idx in self.mints.items()}
         try:
             with open(vocabFile, "w", encoding="utf-8") as f:
                 for idx, token in vocab.items():
-                    s = renderToken(token)
+                    s = util.renderToken(token)
                     if idx in invertedMerges:
                         idx0, idx1 = invertedMerges[idx]
-                        s0 = renderToken(vocab[idx0])
-                        s1 = renderToken(vocab[idx1])
+                        s0 = util.renderToken(vocab[idx0])
+                        s1 = util.renderToken(vocab[idx1])
                         f.write(f"[{s0}][{s1}] -> [{s}] {idx}\n")
                     else:
                         f.write(f"[{s}] {idx}\n")
         except Exception as e:
-            print(f"[Thoth]: An error occurred when writing to file: {e}")
+            logger.error("[Thoth]: An error occurred when writing to file: %s", e)
@@ -0,0 +1,58 @@
+"""Logging and metrics hooks for the tokenizers; both cost nothing until enabled."""
+
+import logging
+import time
+from contextlib import contextmanager, nullcontext
+
+# Progress and diagnostics go to the "thoth" logger; it is silent unless the application configures logging
+logger = logging.getLogger("thoth")
+logger.addHandler(logging.NullHandler())
+
+class Metrics:
+    """
+    - Collects counters and phase timings from a tokenizer (see `Tokenizer.setMetrics`).
+    - Phases are timed as "<operation>.<phase>", e.g. "encode.split" (regex / word splitting), "encode.merge" (BPE merge loop and cache lookups), "decode.total", "train.count", "train.merge".
+    - Counters include "encode.bytes", "encode.tokens", "encode.cacheHits", "encode.cacheMisses", "decode.bytes", "decode.tokens" and "train.merges".
+    - Subclass it (or pass any object with `count` and `observe`) to forward the events to another metrics system.
+    """
+
+    def __init__(self) -> None:
+        self.counters = {} # name -> total
+        self.timings = {} # name -> [calls, total seconds]
+
+    def count(self, name: str, value: int = 1) -> None:
+        """Description: Adds `value` to the counter `name`"""
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, seconds: float) -> None:
+        """Description: Records one timed run of the phase `name`"""
+        timing = self.timings.get(name)
+        if timing is None:
+            timing = self.timings[name] = [0, 0.0]
+        timing[0] += 1
+        timing[1] += seconds
+
+    def snapshot(self) -> dict:
+        """Description: Returns a copy of every counter and timing as plain dicts (e.g. for JSON)"""
+        return {
+            "counters": dict(self.counters),
+            "timings": {name: {"calls": calls, "seconds": seconds} for name, (calls, seconds) in self.timings.items()},
+        }
+
+    def reset(self) -> None:
+        """Description: Clears every counter and timing"""
+        self.counters.clear()
+        self.timings.clear()
+
+@contextmanager
+def timedPhase(metrics, name: str):
+    """Description: Context manager that reports the time spent in its block to `metrics.observe(name, ...)`"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe(name, time.perf_counter() - start)
+
+def phase(metrics, name: str):
+    """Description: Returns `timedPhase(metrics, name)`, or a no-op context when metrics are disabled (None); meant for coarse phases such as training"""
+    return nullcontext() if metrics is None else timedPhase(metrics, name)
@@ -1,144 +1,228 @@
 # The Llama-2 Tokenizer uses sentencepiece, which is what is adopted here
-
-class Llama2Tokenizer:
-    def __init__(self) -> None:
-            self.vocab = {} # Initialize the vocabulary
+import re
+import time
+from collections import Counter
+
+import utils as util
+from bpeTrainer import BPETrainer
+from instrumentation import logger, phase
+from tokenizer import StreamDecoder, Tokenizer, packMerges, unpackMerges
+
+SPACE_SYMBOL = "\u2581" # "▁": SentencePiece's visible stand-in for a space
+CHARACTER_COVERAGE = 0.9995 # share of the training characters the seed vocab must cover (SentencePiece's default)
+# Training units: a word with its leading space, ending at a newline (extra spaces are pieces of their own). Every piece starts at a space or after a newline, so merges never span words or lines
+WORD_SPLIT_PATTERN = re.compile(r" ?[^ \n]+\n?| ?\n| ")
+
+class Llama2Tokenizer(Tokenizer):
+    """
+    - SentencePiece-style BPE over Unicode characters (code points) rather than bytes.
+    - Spaces are normalized to "▁" and the text gets a dummy "▁" prefix, so a word is the same token at the start of the text and after a space; decoding turns them back (a literal "▁" in the input decodes as a space).
+    - Ids 0-255 are byte-fallback tokens: a character outside the seed vocab is encoded as the ids of its UTF-8 bytes, so any text round-trips.
+    - Ids 256 onward are the seed characters (most common first), followed by the merged tokens in the order they were learned; `self.vocab` maps every id to its bytes.
+    """
+
+    def __init__(self, cacheSize: int = util.CHUNK_CACHE_SIZE) -> None:
+            self.vocab = {idx: bytes([idx]) for idx in range(256)} # idx -> bytes (byte-fallback tokens only until trained)
+            self.seedIds = {} # seed character -> idx
+            self.merges = {} # (int, int) -> int
             self.tokenCounter = len(self.vocab) # Start token counter after initial vocabulary
+            self.setCacheSize(cacheSize)
+
+    def setCacheSize(self, cacheSize: int) -> None:
+        """Description: Resizes the word -> ids LRU cache (0 or None turns it off); cached encodings are dropped"""
+        self.wordCache = util.LRUCache(cacheSize) if cacheSize else None
+
+    def __getstate__(self) -> dict:
+        """Description: Pickles the tokenizer (e.g. for batch worker processes) with an empty word cache of the same size"""
+        state = super().__getstate__()
+        if self.wordCache is not None:
+            state["wordCache"] = util.LRUCache(self.wordCache.maxSize, self.wordCache.maxKeyLength)
+        return state
 
-    def train(self, text: str, vocabSize: int) -> None:
-        """Description: Trains the tokenizer"""
+    def train(self, text: str, vocabSize: int, characterCoverage: float = CHARACTER_COVERAGE, numWorkers: int = None) -> None:
+        """Description: Trains the tokenizer (splitting and counting words in `numWorkers` processes if given)"""
         assert (vocabSize >= 256)
         if len(text) == 0:
             raise ValueError("[Thoth => train]: String empty. Nothing to train on.")
-
-        print("[Thoth => train]: Training...")
-
-        # Convert the text to a list of Unicode code points
-        codePoints = [ord(char) for char in text]
-        self.tokenCounter = max(codePoints)
-        # Initialize the vocabulary with the most common code points
-        self.vocab = self.mostCommonCodepoints(codePoints)
-        # Initialize the BPE merges
-        self.merges = {}
-        numOfMerges = vocabSize - 256
-
-        # Perform BPE training
-        for _ in range(numOfMerges):
-            # Count the frequency of each pair of code points
-            pairCounts = self.countPairFrequencies(codePoints)
-            # Find the most frequent pair of code points
-            mostFrequentPair = max(pairCounts, key=pairCounts.get)
-            # Merge the most frequent pair into a new token
-            newToken = self.generateNewToken()
-            # Update the vocabulary and the list of code points
-            self.vocab[newToken] = mostFrequentPair
-            codePoints = self.mergeItemsReplace(codePoints, mostFrequentPair, newToken)
-
-        # Store the final vocabulary and merges
-        self.vocab = {token: self.vocab[token] for token in self.vocab if isinstance(token, int)}
-        self.merges = {pair: token for token, pair in self.vocab.items() if isinstance(pair, tuple)}
+        self.trainStream([text], vocabSize, characterCoverage=characterCoverage, numWorkers=numWorkers)
+
+    def trainStream(self, sources, vocabSize: int, characterCoverage: float = CHARACTER_COVERAGE, maxUniqueChunks: int = None, pieceSize: int = util.CORPUS_PIECE_SIZE, numWorkers: int = None) -> None:
+        """
+        - Trains the tokenizer on a corpus stream (paths, files, str lines, or byte chunks read as one stream; see `utils.corpusSources`), modelled on SentencePiece's BPE trainer.
+        - The corpus is streamed into a unique word -> count table (see `WORD_SPLIT_PATTERN`; every source gets the encoder's dummy space prefix, and words have their leading space normalized to "▁"), so each distinct word is trained on once.
+        - The seed vocab is "▁" plus the smallest set of most common characters covering `characterCoverage` of the corpus (at most vocabSize - 256 in all); rarer characters are left to byte fallback and never merged.
+        - Merges are learned with the incremental `BPETrainer` until the vocab (byte-fallback tokens + seeds + merges) reaches `vocabSize`.
+
+        Parameters:
+        - sources: A path, file object or str, or an iterable of them and of bytes pieces (see `utils.corpusSources`).
+        - vocabSize (int): Total vocab size, including the 256 byte-fallback tokens.
+        - characterCoverage (float): Share of the training characters the seed vocab covers.
+        - maxUniqueChunks (int, optional): Bounds the word table by pruning rare words.
+        - pieceSize (int): Read size for paths and file objects.
+        - numWorkers (int, optional): Processes used to split and count the corpus.
+
+        Returns:
+        - None
+        """
+        assert (vocabSize >= 256)
+        assert (0 < characterCoverage <= 1)
+        with phase(self.metrics, "train.count"):
+            prefixedSources = (withDummyPrefix(source, pieceSize) for source in util.corpusSources(sources))
+            wordCounts = util.countStreamChunks(prefixedSources, WORD_SPLIT_PATTERN, maxUniqueChunks=maxUniqueChunks, pieceSize=pieceSize, numWorkers=numWorkers)
+        if len(wordCounts) == 0:
+            raise ValueError("[Thoth => train]: Stream empty. Nothing to train on.")
+
+        logger.info("[Thoth => train]: Training on %d unique words...", len(wordCounts))
+
+        # Normalize each unique word the way the encoder normalizes text
+        words = [word.decode("utf-8").replace(" ", SPACE_SYMBOL) for word in wordCounts]
+        counts = list(wordCounts.values())
+        charCounts = Counter()
+        for word, count in zip(words, counts):
+            for char in word:
+                charCounts[char] += count
+        # The vocabulary is the byte-fallback tokens, then the covered characters, then the merges (vocabSize in total)
+        self.vocab = {idx: bytes([idx]) for idx in range(256)}
+        self.seedIds = {}
+        seeds = self.coveredCharacters(charCounts, characterCoverage, vocabSize - 256)
+        if SPACE_SYMBOL not in seeds and vocabSize > 256:
+            # Always seed "▁": as byte fallback every space would cost three tokens (e.g. on CJK text, where spaces are rare)
+            seeds = seeds[:vocabSize - 257] + [SPACE_SYMBOL]
+        for char in seeds:
+            self.seedIds[char] = len(self.vocab)
+            self.vocab[len(self.vocab)] = char.encode("utf-8")
+        self.tokenCounter = len(self.vocab)
+
+        # Characters outside the seed vocab are never merged: they split a word into separately trained runs
+        chunks, chunkCounts = [], []
+        for word, count in zip(words, counts):
+            run = []
+            for char in word:
+                idx = self.seedIds.get(char)
+                if idx is not None:
+                    run.append(idx)
+                elif run:
+                    chunks.append(run)
+                    chunkCounts.append(count)
+                    run = []
+            if run:
+                chunks.append(run)
+                chunkCounts.append(count)
+
+        # Perform BPE training, weighting every word by how often it occurred
+        with phase(self.metrics, "train.merge"):
+            trainer = BPETrainer(chunks, chunkCounts)
+            self.merges = trainer.train(vocabSize - len(self.vocab), len(self.vocab), callback=self.mintToken) # (int, int) -> int
+        if self.metrics is not None:
+            self.metrics.count("train.merges", len(self.merges))
+        if self.wordCache is not None:
+            self.wordCache.clear()
         
-        print("[Thoth => train]: Training complete.")
-
-    def encoder(self, text: str) -> list[int]:
-        """Description: Encodes input text to a compressed sequence of integers"""
-
+        logger.info("[Thoth => train]: Training complete.")
+
+    def encoder(self, text: str, outputType: str = "list") -> list[int]:
+        """
+        - Encodes input text to a compressed sequence of integers (returned as a list, array, memoryview or NumPy array per `outputType`).
+        - Adds a dummy space prefix and splits the text into the words the trainer learned from (merges never span them); each word is encoded once and then served from the word cache.
+        - See `encodeWord` for the per-word BPE: O(n log n) overall.
+        """
         if len(text) == 0:
             raise ValueError("[Thoth => encoder]: String empty. Nothing to encode.")
 
-        print("[Thoth => encoder]: Encoding...")
-        # Convert the text to a list of Unicode code points
-        codePoints = [ord(char) for char in text]
-
-        # Encode the text using the trained BPE model
-        encoded = []
-        i = 0
-        while i < len(codePoints):
-            # Start with the longest possible sequence
-            sequenceLength = min(len(codePoints) - i, max((len(k) if isinstance(k, tuple) else 1 for k in self.vocab.keys())))
-            while sequenceLength > 0:
-                sequence = tuple(codePoints[i:i+sequenceLength])
-                if sequence in self.vocab:
-                    encoded.append(self.vocab[sequence])
-                    i += sequenceLength
-                    break
-                else:
-                    # If no sequence is found, use the first code point as a fallback
-                    encoded.append(codePoints[i])
-                    i += 1
-                sequenceLength -= 1
-
-        print("[Thoth => encoder]: Encoding Complete...")
-        return encoded
+        metrics = self.metrics
+        started = time.perf_counter() if metrics is not None else 0.0
+        cache = self.wordCache
+        encodedIntegers = util.newIdBuffer(outputType, self.getFlatVocab().size)
+        words = WORD_SPLIT_PATTERN.findall(" " + text)
+        if metrics is not None:
+            split = time.perf_counter()
+            hits, misses = (cache.hits, cache.misses) if cache is not None else (0, 0)
+        for word in words:
+            encodeIDs = cache.get(word) if cache is not None else None
+            if encodeIDs is None:
+                encodeIDs = self.encodeWord(word)
+                if cache is not None:
+                    cache.put(word, tuple(encodeIDs))
+            encodedIntegers.extend(encodeIDs)
+        if metrics is not None:
+            metrics.observe("encode.split", split - started)
+            metrics.observe("encode.merge", time.perf_counter() - split)
+            metrics.count("encode.cacheHits", cache.hits - hits if cache is not None else 0)
+            metrics.count("encode.cacheMisses", cache.misses - misses if cache is not None else len(words))
+            self.recordCall("encode", started, len(encodedIntegers), len(text.encode("utf-8")))
+        return util.finishIds(encodedIntegers, outputType)
 
     def decoder(self, ids: list[int]) -> str:
         """Description: Inverse of Encoder -> Converts encoded text into human-readable text input text"""
-
         if len(ids) == 0:
             raise ValueError("[Thoth => decoder]: No IDs. Nothing to decode.")
     
-        print("[Thoth => decoder]: Decoding...")
-
-        # Decode the encoded sequence using the trained BPE model
-        decoded = []
-        for token in ids:
-            # Retrieve the sequence of code points for the token
-            sequence = self.vocab.get(token, (token,))
-            # Ensure that the sequence is a tuple of integers
-            if isinstance(sequence, str):
-                sequence = tuple(ord(char) for char in sequence)
-            # Convert the sequence of code points back to a string
-            decoded.extend(sequence)
-
-        print("[Thoth => decoder]: Decoding Complete...")
-        return ''.join(chr(codePoint) for codePoint in decoded)
+        metrics = self.metrics
+        started = time.perf_counter() if metrics is not None else 0.0
+        # Seed, merged and byte-fallback tokens all map to bytes, so consecutive byte-fallback tokens rejoin into their character
+        textBytes = self.decodeBytes(ids)
+        if metrics is not None:
+            self.recordCall("decode", started, len(ids), len(textBytes))
+        text = textBytes.decode("utf-8", errors="replace").replace(SPACE_SYMBOL, " ")
+        return text[1:] if text.startswith(" ") else text # drop the dummy prefix
+
+    def streamDecoder(self) -> StreamDecoder:
+        """Description: Returns a stateful decoder for ids that arrive one at a time (see `Tokenizer.streamDecoder`), turning "▁" back into spaces and dropping the dummy prefix"""
+        return StreamDecoder(self.decodeBytes, dropPrefix=" ", textReplace=(SPACE_SYMBOL, " "))
 
     ########################################################
     ################### HELPER FUNCTIONS ###################
     ########################################################
 
-    def countPairFrequencies(self, codePoints):
-        """Description: Counts the frequency of each pair of consecutive Unicode code points."""
-        pairCounts = {}
-        for i in range(len(codePoints) - 1):
-            pair = (codePoints[i], codePoints[i + 1])
-            if pair in pairCounts:
-                pairCounts[pair] += 1
-            else:
-                pairCounts[pair] = 1
-        return pairCounts
-
-    def mergeItemsReplace(self, items, pair, newItem):
-        """Description: Merges a pair of consecutive items in a list with a new item."""
-        mergedItems = []
-        i = 0
-        while i < len(items):
-            if i < len(items) - 1 and items[i:i+2] == pair:
-                mergedItems.append(newItem)
-                i += 2
+    def encodeWord(self, word: str) -> list[int]:
+        """Description: Normalizes spaces to "▁", maps every character to its seed id (or the byte-fallback ids of its UTF-8 bytes), then applies the merges in the order they were learned, like SentencePiece's BPE"""
+        seedIds = self.seedIds
+        ids = []
+        for char in word.replace(" ", SPACE_SYMBOL):
+            idx = seedIds.get(char)
+            if idx is None:
+                ids.extend(char.encode("utf-8")) # byte fallback
             else:
-                mergedItems.append(items[i])
-                i += 1
-        return mergedItems
-    
-    def generateNewToken(self):
-        """Description: Generates a new token for a merged pair of Unicode code points."""
-        newToken = self.tokenCounter
-        self.tokenCounter += 1
-        return newToken
-    
-    def mostCommonCodepoints(self, codepoints, topN = 256):
-        """Description: Returns a sorted dictionary of the most common codepoints"""
-        from collections import Counter
-        # Count occurrences of each codepoint
-        counts = Counter(codepoints)
-        # Sort by count and then by codepoint (to break ties)
-        sortedCounts = sorted(counts.items(), key=lambda x: (-x[1], x[0]))
-        # Select the top N most common codepoints
-        topCodepoints = sortedCounts[:topN]
-        # Convert to a dictionary mapping codepoints to characters
-        topCodepointsDict = {codepoint: chr(codepoint) for codepoint, count in topCodepoints} # K: codepoint int, V: codepoint char 
-        return topCodepointsDict
+                ids.append(idx)
+        return util.applyMerges(ids, self.merges)
+
+    def modelSections(self) -> tuple[dict, dict]:
+        """Description: Saves the merges and flat vocab, plus how many seed characters follow the byte-fallback tokens"""
+        flatVocab = self.getFlatVocab()
+        sections = {"merges": packMerges(self.merges), "vocabOffsets": flatVocab.offsets, "vocabBlob": flatVocab.blob}
+        return {"numSeeds": len(self.seedIds)}, sections
+
+    def loadSections(self, metadata: dict, sections: dict) -> None:
+        """Description: Restores a saved Llama2Tokenizer"""
+        self.merges = unpackMerges(sections["merges"])
+        self.vocab = util.FlatVocab.fromBuffers(sections["vocabBlob"], sections["vocabOffsets"])
+        self.seedIds = {self.vocab[idx].decode("utf-8"): idx for idx in range(256, 256 + metadata["numSeeds"])}
+        self.tokenCounter = self.vocab.size
+        self.setCacheSize(util.CHUNK_CACHE_SIZE)
+
+    def mintToken(self, pair: tuple[int, int], idx: int, count: int) -> None:
+        """Description: Registers the bytes of a merged pair of tokens (called by the trainer after every merge)"""
+        self.vocab[idx] = self.vocab[pair[0]] + self.vocab[pair[1]]
+        self.tokenCounter = idx + 1
+
+    def coveredCharacters(self, charCounts: dict[str, int], characterCoverage: float, limit: int) -> list[str]:
+        """Description: Returns the fewest most common characters (ties broken by code point) covering `characterCoverage` of all occurrences, at most `limit`"""
+        total = sum(charCounts.values())
+        covered, characters = 0, []
+        for char, count in sorted(charCounts.items(), key=lambda x: (-x[1], x[0])):
+            if covered >= characterCoverage * total or len(characters) >= limit:
+                break
+            characters.append(char)
+            covered += count
+        return characters
+
+def withDummyPrefix(source, pieceSize: int = util.CORPUS_PIECE_SIZE):
+    """Description: Yields the str pieces of one corpus source (see `utils.readCorpus`) behind the dummy " " prefix the encoder gives every text; empty sources stay empty"""
+    pieces = util.readCorpus(source, pieceSize)
+    for piece in pieces:
+        yield " "
+        yield piece
+        yield from pieces
 
 if __name__ == "__main__":
     Llama2TokenizerInstance = Llama2Tokenizer()
@@ -146,7 +230,7 @@ if __name__ == "__main__":
     with open(filePath, 'r', encoding='utf-8') as file:
         fileContent = file.read()
     sampleText = "Ｕｎｉｃｏｄｅ! 🅤🅝🅘🅒🅞🅓🅔‽ 🇺‌🇳‌🇮‌🇨‌🇴‌🇩‌🇪! 😄 The very name strikes fear and awe into the hearts of programmers worldwide. We all know we ought to “support Unicode” in our software (whatever that means—like using wchar_t for all the strings, right?). But Unicode can be abstruse, and diving into the thousand-page Unicode Standard plus its dozens of supplementary annexes, reports, and notes can be more than a little intimidating. I don’t blame programmers for still finding the whole thing mysterious, even 30 years after Unicode’s inception."
-    vocabSize = 276
+    vocabSize = 600
 
     # print("\n" + sampleText + "\n")
     Llama2TokenizerInstance.train(sampleText, vocabSize)
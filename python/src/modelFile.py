@@ -0,0 +1,83 @@
+"""Compact, versioned binary container for tokenizer tables, read back through a memory map."""
+
+import mmap
+import os
+import struct
+import sys
+import tempfile
+
+MODEL_FILE_MAGIC = b"THOTHMDL"
+MODEL_FILE_VERSION = 1
+HEADER = struct.Struct("<8sIIcxxx") # magic, container version, number of sections, byte order ("<" or ">")
+SECTION = struct.Struct("<16sQQ") # name, offset, length
+ALIGNMENT = 8
+
+def writeModelFile(path: str, sections: dict[str, bytes]) -> None:
+    """
+    - Writes named binary sections (bytes, bytearray, array or memoryview) to `path`.
+    - Layout: a header, a table of (name, offset, length) entries, then each payload aligned to 8 bytes so typed arrays can be viewed in place.
+    - The file is written to a temporary name and renamed into place, so concurrent readers never see a partial file.
+
+    Parameters:
+    - path (str): Destination file.
+    - sections (dict): Section name (at most 16 ASCII characters) -> payload.
+
+    Returns:
+    - None
+    """
+    payloads = [(name.encode("ascii"), memoryview(payload).cast("B")) for name, payload in sections.items()]
+    offset = HEADER.size + SECTION.size * len(payloads)
+    table = []
+    for name, payload in payloads:
+        if len(name) > 16:
+            raise ValueError(f"[Thoth => writeModelFile]: Section name {name!r} is longer than 16 characters.")
+        offset += -offset % ALIGNMENT
+        table.append((name, offset, len(payload)))
+        offset += len(payload)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmpPath = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            byteOrder = b"<" if sys.byteorder == "little" else b">"
+            f.write(HEADER.pack(MODEL_FILE_MAGIC, MODEL_FILE_VERSION, len(table), byteOrder))
+            for name, start, length in table:
+                f.write(SECTION.pack(name, start, length))
+            for (name, start, length), (_, payload) in zip(table, payloads):
+                f.write(b"\0" * (start - f.tell()))
+                f.write(payload)
+        os.replace(tmpPath, path)
+    except BaseException:
+        os.unlink(tmpPath)
+        raise
+
+def readModelFile(path: str) -> tuple[mmap.mmap, dict[str, memoryview]]:
+    """
+    - Memory-maps a file written by `writeModelFile` and returns (mmap, section name -> memoryview).
+    - Nothing is copied: the views point into the shared page cache, so every process loading the same file shares its pages.
+    - Raises ValueError if the file is not a model file, was written by another container version, or has the other byte order.
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size < HEADER.size:
+            raise ValueError(f"[Thoth => readModelFile]: {path} is too short to be a model file.")
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        magic, version, numSections, byteOrder = HEADER.unpack_from(mm, 0)
+        if magic != MODEL_FILE_MAGIC:
+            raise ValueError(f"[Thoth => readModelFile]: {path} is not a Thoth model file.")
+        if version != MODEL_FILE_VERSION:
+            raise ValueError(f"[Thoth => readModelFile]: {path} has container version {version}, expected {MODEL_FILE_VERSION}.")
+        if byteOrder != (b"<" if sys.byteorder == "little" else b">"):
+            raise ValueError(f"[Thoth => readModelFile]: {path} was written on a machine with the other byte order.")
+        if HEADER.size + numSections * SECTION.size > len(mm):
+            raise ValueError(f"[Thoth => readModelFile]: {path} is truncated.")
+        table = [SECTION.unpack_from(mm, HEADER.size + i * SECTION.size) for i in range(numSections)]
+        if any(start + length > len(mm) for _, start, length in table):
+            raise ValueError(f"[Thoth => readModelFile]: {path} is truncated.")
+    except BaseException:
+        mm.close()
+        raise
+    view = memoryview(mm)
+    sections = {name.rstrip(b"\0").decode("ascii"): view[start:start + length] for name, start, length in table}
+    return mm, sections
@@ -1,88 +1,342 @@
+import time
+
 import regex as re
 import utils as util
+from bpeTrainer import BPETrainer
+from instrumentation import logger, phase
+from tokenizer import Tokenizer
 
 GPT2_SPLIT_PATTERN = r"""'(?:[sdmt]|ll|ve|re)| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+"""
 GPT4_SPLIT_PATTERN = r"""'(?i:[sdmt]|ll|ve|re)|[^\r\n\p{L}\p{N}]?+\p{L}+|\p{N}{1,3}| ?[^\s\p{L}\p{N}]++[\r\n]*|\s*[\r\n]|\s+(?!\S)|\s+"""
+TRUNCATE_SIDES = ("right", "left") # "right" keeps the first tokens, "left" the last ones
+
+class RegexTokenizer(Tokenizer):
+    def __init__(self, pattern: str = None, cacheSize: int = util.CHUNK_CACHE_SIZE) -> None:
+        self.pattern = GPT4_SPLIT_PATTERN if pattern is None else pattern
+        self.compiledPattern = re.compile(self.pattern)
+        self.registerSpecialTokens({})
+        self.setCacheSize(cacheSize)
+
+    def setCacheSize(self, cacheSize: int) -> None:
+        """Description: Resizes the chunk -> ids LRU cache (0 or None turns it off); cached encodings are dropped"""
+        self.chunkCache = util.LRUCache(cacheSize) if cacheSize else None
+
+    def registerSpecialTokens(self, specialTokens: dict[str, int]) -> None:
+        """Description: Registers special tokens (str -> int) that live outside the merges, e.g. GPT-4's <|endoftext|>"""
+        self.specialTokens = dict(specialTokens)
+        self.inverseSpecialTokens = {v: k for k, v in self.specialTokens.items()}
+        self.specialMatcher = util.SpecialTokenMatcher(self.specialTokens)
+
+    def modelSections(self) -> tuple[dict, dict]:
+        """Description: Adds the split pattern and special tokens to the saved merges and vocab"""
+        metadata, sections = super().modelSections()
+        metadata.update(pattern=self.pattern, specialTokens=self.specialTokens)
+        return metadata, sections
+
+    def loadSections(self, metadata: dict, sections: dict) -> None:
+        """Description: Restores a saved RegexTokenizer (with a default sized chunk cache)"""
+        super().loadSections(metadata, sections)
+        self.pattern = metadata["pattern"]
+        self.compiledPattern = re.compile(self.pattern)
+        self.registerSpecialTokens(metadata["specialTokens"])
+        self.setCacheSize(util.CHUNK_CACHE_SIZE)
 
-class RegexTokenizer:
-    def __init__(self) -> None:
-        pass
+    def __getstate__(self) -> dict:
+        """Description: Pickles the tokenizer (e.g. for batch worker processes) with an empty chunk cache of the same size"""
+        state = super().__getstate__()
+        if self.chunkCache is not None:
+            state["chunkCache"] = util.LRUCache(self.chunkCache.maxSize, self.chunkCache.maxKeyLength)
+        return state
 
-    def train(self, text: str, vocabSize: int) -> None:
-        """Description: Trains the tokenizer"""
+    def train(self, text: str, vocabSize: int, dedupChunks: bool = True, numWorkers: int = None) -> None:
+        """Description: Trains the tokenizer (on unique chunk frequencies unless `dedupChunks` is False, splitting in `numWorkers` processes if given)"""
         assert (vocabSize >= 256)
         if len(text) == 0:
             raise ValueError("[Thoth => train]: String empty. Nothing to train on.")
         
-        print("[Thoth => train]: Training...")
+        if dedupChunks:
+            # Identical chunks produce identical pair counts, so train on a unique-chunk -> count table instead
+            with phase(self.metrics, "train.count"):
+                if numWorkers is not None and numWorkers > 1:
+                    chunkCounts = util.countStreamChunks([text], self.compiledPattern, numWorkers=numWorkers)
+                else:
+                    chunkCounts = util.countChunkFrequencies([text], self.compiledPattern)
+            self.trainFromChunkCounts(chunkCounts, vocabSize)
+            return
 
-        idx = 256
-        numOfMerges = vocabSize - 256
-        self.compiledPattern = re.compile(GPT4_SPLIT_PATTERN)
-        tokens = re.findall(self.compiledPattern, text)
+        logger.info("[Thoth => train]: Training...")
+
+        with phase(self.metrics, "train.count"):
+            tokens = re.findall(self.compiledPattern, text)
 
         encodeIDsList = [list(token.encode("utf-8")) for token in tokens]
 
-        self.mints = {} # (int, int) -> int
         self.vocab = {idx: bytes([idx]) for idx in range(256)} # idx -> bytes
-        for i in range(numOfMerges):
-            commonTuples = {}
-            for encodeIDs in encodeIDsList:
-                util.countCommonEncodedTuples(encodeIDs, commonTuples)
-            pair = max(commonTuples, key=commonTuples.get)
-            idx += i
-            encodeIDsList = [util.merge(encodeIDs, pair, idx) for encodeIDs in encodeIDsList]
-            self.mints[pair] = idx
-            self.vocab[idx] = self.vocab[pair[0]] + self.vocab[pair[1]]
-
-        print("[Thoth => train]: Training complete.")
-
-    def encoder(self, text: str) -> list[int]:
-        """Description: Encodes input text to a compressed sequence of integers"""
+        self.trainMerges(encodeIDsList, None, vocabSize)
+
+        logger.info("[Thoth => train]: Training complete.")
+
+    def trainStream(self, sources, vocabSize: int, maxUniqueChunks: int = None, pieceSize: int = util.CORPUS_PIECE_SIZE, numWorkers: int = None) -> None:
+        """Description: Trains the tokenizer on a corpus stream (paths, files, str lines, or byte chunks read as one stream; see `utils.corpusSources`) without loading the corpus into one string"""
+        with phase(self.metrics, "train.count"):
+            chunkCounts = util.countStreamChunks(sources, self.compiledPattern, maxUniqueChunks=maxUniqueChunks, pieceSize=pieceSize, numWorkers=numWorkers)
+        self.trainFromChunkCounts(chunkCounts, vocabSize)
+
+    def trainFromChunkCounts(self, chunkCounts: dict[bytes, int], vocabSize: int) -> None:
+        """Description: Trains the tokenizer on a unique-chunk -> count table (see `utils.countChunkFrequencies`)"""
+        assert (vocabSize >= 256)
+        if len(chunkCounts) == 0:
+            raise ValueError("[Thoth => train]: No chunks. Nothing to train on.")
+
+        logger.info("[Thoth => train]: Training on %d unique chunks...", len(chunkCounts))
+
+        self.vocab = {idx: bytes([idx]) for idx in range(256)} # idx -> bytes
+        # Each unique chunk is stored once; its pair counts are weighted by how often it occurred
+        self.trainMerges([list(chunk) for chunk in chunkCounts], list(chunkCounts.values()), vocabSize)
+
+        logger.info("[Thoth => train]: Training complete.")
+
+    def encoder(self, text: str, outputType: str = "list", allowedSpecial=(), disallowedSpecial=()) -> list[int]:
+        """
+        - Encodes input text to a compressed sequence of integers (returned as a list, array, memoryview or NumPy array per `outputType`).
+        - Registered special tokens in `allowedSpecial` ("all" or a collection of token strings) are emitted as their special ids; the regex + BPE path only runs on the text between them.
+        - Finding one of `disallowedSpecial` ("all": every registered token not allowed) raises ValueError; any other special token is encoded as ordinary text.
+
+        Parameters:
+        - text (str): The text to encode.
+        - outputType (str): "list", "array", "memoryview" or "numpy".
+        - allowedSpecial ("all" or collection of str): Special tokens to encode as special ids.
+        - disallowedSpecial ("all" or collection of str): Special tokens that must not appear in the text.
+
+        Returns:
+        - list: The token ids.
+        """
         if len(text) == 0:
             raise ValueError("[Thoth => encoder]: String empty. Nothing to encode.")
 
-        print("[Thoth => encoder]: Encoding...")
-        tokens = re.findall(self.compiledPattern, text)
-        encodedIntegers = []
-        for token in tokens:
-            tokenUTF8 = token.encode("utf-8") # raw bytes
-            encodeIDs = self.chunkify(tokenUTF8)
-            encodedIntegers.extend(encodeIDs)
-        print("[Thoth => encoder]: Encoding Complete...")
-        return encodedIntegers
+        metrics = self.metrics
+        started = time.perf_counter() if metrics is not None else 0.0
+        allowed, disallowed = self.selectSpecialTokens(allowedSpecial, disallowedSpecial)
+        encodedIntegers = util.newIdBuffer(outputType, max(self.getFlatVocab().size, max(self.inverseSpecialTokens, default=-1) + 1))
+        start = 0
+        if allowed or disallowed:
+            # One pass over the text finds every special token; ordinary text is encoded span by span in between
+            for matchStart, matchEnd, token in self.specialMatcher.finditer(text):
+                if token in allowed:
+                    self.encodeOrdinary(text[start:matchStart], encodedIntegers)
+                    encodedIntegers.append(self.specialTokens[token])
+                    start = matchEnd
+                elif token in disallowed:
+                    raise ValueError(f"[Thoth => encoder]: Text contains the disallowed special token {token!r} (pass it in allowedSpecial to encode it as a special token).")
+        self.encodeOrdinary(text[start:], encodedIntegers)
+        if metrics is not None:
+            self.recordCall("encode", started, len(encodedIntegers), len(text.encode("utf-8")))
+        return util.finishIds(encodedIntegers, outputType)
     
+    def encodeStream(self, source, pieceSize: int = util.CORPUS_PIECE_SIZE):
+        """
+        - Encodes an unbounded text stream (a path, file object, or iterable of str / bytes pieces), yielding token ids as soon as they are settled.
+        - Only the last, possibly incomplete regex chunk is held back between pieces (see `utils.splitStream`), so memory stays constant and ids start flowing after the first piece.
+        - Yields the same ids as `encoder` on the concatenated text (special tokens are encoded as ordinary text).
+
+        Parameters:
+        - source: A path, file object, str, or iterable of str / bytes pieces (see `utils.readCorpus`).
+        - pieceSize (int): Read size for paths and file objects.
+
+        Returns:
+        - Generator of token ids.
+        """
+        encodedIntegers = []
+        for chunk in util.splitStream(util.readCorpus(source, pieceSize), self.compiledPattern):
+            self.encodeChunks((chunk,), encodedIntegers)
+            yield from encodedIntegers
+            encodedIntegers.clear()
+
+    def countTokens(self, text: str, allowedSpecial=()) -> int:
+        """
+        - Returns `len(self.encoder(text, allowedSpecial=allowedSpecial))` (0 for empty text) without building the id list.
+        - Goes through the same regex split, chunk cache and BPE as `encoder`, adding up chunk lengths instead of copying ids.
+        """
+        cache = self.chunkCache
+        numTokens = 0
+        for segment, specialId in self.iterSegments(text, allowedSpecial):
+            if specialId is not None:
+                numTokens += 1
+                continue
+            for chunk in re.findall(self.compiledPattern, segment):
+                encodeIDs = cache.get(chunk) if cache is not None else None
+                numTokens += len(encodeIDs if encodeIDs is not None else self.chunkIds(chunk, lookup=False))
+        return numTokens
+
+    def truncate(self, text: str, maxTokens: int, side: str = "right", allowedSpecial=()) -> str:
+        """
+        - Cuts `text` to at most `maxTokens` tokens: the same text as `self.decoder(ids[:maxTokens])` ("right") or `self.decoder(ids[-maxTokens:])` ("left"), where `ids = self.encoder(text, allowedSpecial=allowedSpecial)`.
+        - Whole chunks are copied from the text and only the chunk the cut falls in is decoded (a character split by the cut becomes U+FFFD, as in `decoder`).
+        - "right" stops splitting and encoding as soon as the budget is used up; "left" splits the whole text but only encodes chunks from the end until the budget is used up.
+
+        Parameters:
+        - text (str): The text to truncate.
+        - maxTokens (int): Token budget.
+        - side (str): "right" drops tokens from the end, "left" from the start.
+        - allowedSpecial ("all" or collection of str): Special tokens counted as one special id (see `encoder`).
+
+        Returns:
+        - str: The truncated text.
+        """
+        if side not in TRUNCATE_SIDES:
+            raise ValueError(f"[Thoth => truncate]: Unknown side {side!r}, expected one of {TRUNCATE_SIDES}.")
+        if maxTokens < 0:
+            raise ValueError("[Thoth => truncate]: maxTokens must not be negative.")
+        if side == "right":
+            chunks = self.iterChunks(text, allowedSpecial)
+        else:
+            chunks = []
+            for segment, specialId in self.iterSegments(text, allowedSpecial):
+                if specialId is not None:
+                    chunks.append((segment, specialId))
+                else:
+                    chunks.extend((chunk, None) for chunk in re.findall(self.compiledPattern, segment))
+            chunks.reverse()
+        parts, budget = [], maxTokens
+        for chunk, specialId in chunks:
+            if budget == 0:
+                break
+            ids = (specialId,) if specialId is not None else self.chunkIds(chunk)
+            if len(ids) <= budget:
+                parts.append(chunk)
+                budget -= len(ids)
+                continue
+            cutIds = ids[:budget] if side == "right" else ids[len(ids) - budget:]
+            parts.append(self.decodeBytes(cutIds).decode("utf-8", errors="replace"))
+            break
+        return "".join(parts if side == "right" else reversed(parts))
+
     def decoder(self, encodedIntegers: list[int]) -> str:
         """Description: Inverse of Encoder -> Converts encoded text into human-readable text input text"""
         if len(encodedIntegers) == 0:
             raise ValueError("[Thoth => decoder]: No IDs. Nothing to decode.")
 
-        print("[Thoth => decoder]: Decoding...")
-        bytes = []
-        for idx in encodedIntegers:
-            if idx in self.vocab:
-                bytes.append(self.vocab[idx])
-            else:
-                raise ValueError(f"invalid token id: {idx}")
-        joinedBytes = b"".join(bytes)
-        print("[Thoth => decoder]: Decoding Complete...")
+        metrics = self.metrics
+        started = time.perf_counter() if metrics is not None else 0.0
+        joinedBytes = self.decodeBytes(encodedIntegers)
+        if metrics is not None:
+            self.recordCall("decode", started, len(encodedIntegers), len(joinedBytes))
         return joinedBytes.decode("utf-8", errors="replace")
 
     ########################################################
     ################### HELPER FUNCTIONS ###################
     ########################################################
 
+    def trainMerges(self, chunks: list[list[int]], counts: list[int], vocabSize: int) -> None:
+        """Description: Learns `vocabSize` - 256 merges over byte chunks (weighted by `counts` if given), timed as the "train.merge" phase; drops the now stale chunk cache"""
+        with phase(self.metrics, "train.merge"):
+            trainer = BPETrainer(chunks, counts)
+            self.mints = trainer.train(vocabSize - 256, 256, callback=self.mintToken) # (int, int) -> int
+        if self.metrics is not None:
+            self.metrics.count("train.merges", len(self.mints))
+        if self.chunkCache is not None:
+            self.chunkCache.clear()
+
+    def mintToken(self, pair: tuple[int, int], idx: int, count: int) -> None:
+        """Description: Registers the bytes of a newly minted token (called by the trainer after every merge)"""
+        logger.debug("[Thoth => minter]: Minting %s into a new token %d", pair, idx)
+        self.vocab[idx] = self.vocab[pair[0]] + self.vocab[pair[1]]
+
+    def selectSpecialTokens(self, allowedSpecial, disallowedSpecial) -> tuple[set[str], set[str]]:
+        """Description: Resolves the encoder's allowedSpecial / disallowedSpecial options ("all" or collections of tokens) to two disjoint sets"""
+        allowed = set(self.specialTokens) if allowedSpecial == "all" else set(allowedSpecial)
+        unknown = allowed - self.specialTokens.keys()
+        if unknown:
+            raise ValueError(f"[Thoth => encoder]: Unregistered special tokens in allowedSpecial: {sorted(unknown)}.")
+        disallowed = set(self.specialTokens) if disallowedSpecial == "all" else set(disallowedSpecial)
+        return allowed, disallowed - allowed
+
+    def encodeOrdinary(self, text: str, encodedIntegers) -> None:
+        """Description: Appends the ids of `text` (split by the regex, each chunk BPE-encoded or taken from the cache) to `encodedIntegers`"""
+        metrics = self.metrics
+        if metrics is None:
+            self.encodeChunks(re.findall(self.compiledPattern, text), encodedIntegers)
+            return
+        started = time.perf_counter()
+        chunks = re.findall(self.compiledPattern, text)
+        split = time.perf_counter()
+        cache = self.chunkCache
+        hits, misses = (cache.hits, cache.misses) if cache is not None else (0, 0)
+        self.encodeChunks(chunks, encodedIntegers)
+        metrics.observe("encode.split", split - started)
+        metrics.observe("encode.merge", time.perf_counter() - split)
+        metrics.count("encode.cacheHits", cache.hits - hits if cache is not None else 0)
+        metrics.count("encode.cacheMisses", cache.misses - misses if cache is not None else len(chunks))
+
+    def encodeChunks(self, chunks, encodedIntegers) -> None:
+        """Description: Appends the ids of already split regex chunks to `encodedIntegers`, going through the chunk cache"""
+        cache = self.chunkCache
+        for token in chunks:
+            encodeIDs = cache.get(token) if cache is not None else None
+            if encodeIDs is None:
+                tokenUTF8 = token.encode("utf-8") # raw bytes
+                encodeIDs = self.encodeChunk(tokenUTF8)
+                if cache is not None:
+                    cache.put(token, tuple(encodeIDs))
+            encodedIntegers.extend(encodeIDs)
+
+    def iterSegments(self, text: str, allowedSpecial=()):
+        """Description: Lazily splits `text` like `encoder` does around allowed special tokens, yielding (ordinary text, None) and (token, special id) in order"""
+        allowed, _ = self.selectSpecialTokens(allowedSpecial, ())
+        start = 0
+        if allowed:
+            for matchStart, matchEnd, token in self.specialMatcher.finditer(text):
+                if token in allowed:
+                    yield text[start:matchStart], None
+                    yield token, self.specialTokens[token]
+                    start = matchEnd
+        yield text[start:], None
+
+    def iterChunks(self, text: str, allowedSpecial=()):
+        """Description: Lazily yields the pieces `encoder` works through, in order: (regex chunk, None) for ordinary text and (token, special id) for allowed special tokens"""
+        for segment, specialId in self.iterSegments(text, allowedSpecial):
+            if specialId is not None:
+                yield segment, specialId
+                continue
+            for match in self.compiledPattern.finditer(segment):
+                yield match.group(), None
+
+    def chunkIds(self, chunk: str, lookup: bool = True):
+        """Description: Returns the ids of one regex chunk (a tuple from the chunk cache, or a freshly BPE-encoded list that is then cached); `lookup=False` skips the cache lookup the caller already made"""
+        cache = self.chunkCache
+        encodeIDs = cache.get(chunk) if cache is not None and lookup else None
+        if encodeIDs is None:
+            encodeIDs = self.encodeChunk(chunk.encode("utf-8"))
+            if cache is not None:
+                cache.put(chunk, tuple(encodeIDs))
+        return encodeIDs
+
+    def decodeBytes(self, ids) -> bytes:
+        """Description: Returns the bytes behind `ids`, writing special ids out as their token text"""
+        inverseSpecialTokens = self.inverseSpecialTokens
+        gather = self.getFlatVocab().gather
+        if not inverseSpecialTokens or inverseSpecialTokens.keys().isdisjoint(ids):
+            return gather(ids)
+        parts, run = [], []
+        for idx in ids:
+            if idx in inverseSpecialTokens:
+                if run:
+                    parts.append(gather(run))
+                    run = []
+                parts.append(inverseSpecialTokens[idx].encode("utf-8"))
+            else:
+                run.append(idx)
+        if run:
+            parts.append(gather(run))
+        return b"".join(parts)
+
+    def encodeChunk(self, textBytes: bytes) -> list[int]:
+        """Description: Encodes the UTF-8 bytes of one regex chunk (subclasses override this to preprocess the bytes)"""
+        return self.chunkify(textBytes)
+
     def chunkify(self, joinedBytes):
         """Description: Processes a sequence of bytes, merging them based on common patterns to form a compressed sequence of IDs."""
-        ids = list(joinedBytes)
-        while len(ids) >= 2:
-            commonTuples = util.countCommonEncodedTuples(ids)
-            pair = min(commonTuples, key=lambda p: self.mints.get(p, float("inf")))
-            if pair not in self.mints:
-                break
-            idx = self.merges[pair]
-            ids = self.merge(ids, pair, idx)
-        return ids
+        return util.applyMerges(joinedBytes, self.mints)
 
 if __name__ == "__main__":
     RegexTokenizerInstance = RegexTokenizer()
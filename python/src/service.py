@@ -0,0 +1,331 @@
+"""Asyncio tokenization service: micro-batches concurrent encode / decode requests onto a pool of worker processes, each holding one loaded tokenizer."""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor
+
+from instrumentation import logger
+from tokenizer import Tokenizer
+
+MAX_BATCH_SIZE = 64 # requests sent to a worker per task
+MAX_BATCH_DELAY = 0.002 # seconds the first request of a batch waits for company
+MAX_QUEUE_DEPTH = 4096 # pending requests before new ones are rejected
+MAX_REQUEST_BYTES = 1 << 24 # largest HTTP request body accepted
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+class TokenizerService:
+    """
+    - Async front end for a saved tokenizer (see `Tokenizer.save`): `await service.encode(text)` / `await service.decode(ids)` never block the event loop.
+    - Concurrent requests are queued and collected into micro-batches of up to `maxBatchSize`, waiting at most `maxBatchDelay` seconds after the first one, so per-task IPC is paid per batch rather than per request.
+    - Batches run on a process pool where every worker loads the model file once (memory-mapped, so the vocab pages are shared); at most two batches per worker are in flight, which keeps the queue, not the pool, absorbing bursts.
+    - The queue holds at most `maxQueueDepth` requests: beyond that `encode` / `decode` raise `asyncio.QueueFull` instead of letting latency grow without bound.
+    - A request that fails in the tokenizer (e.g. empty text) raises ValueError for that caller only; a batch that fails in the pool (e.g. a worker process died) raises RuntimeError for its callers.
+    - A broken pool is replaced by a fresh one, and `health()` reports the service unhealthy until a batch has succeeded on it.
+    """
+
+    def __init__(self, modelPath: str, numWorkers: int = None, maxBatchSize: int = MAX_BATCH_SIZE, maxBatchDelay: float = MAX_BATCH_DELAY, maxQueueDepth: int = MAX_QUEUE_DEPTH) -> None:
+        assert (maxBatchSize >= 1)
+        assert (maxBatchDelay >= 0)
+        assert (maxQueueDepth >= 1)
+        self.modelPath = modelPath
+        self.numWorkers = numWorkers or os.cpu_count() or 1
+        self.maxBatchSize = maxBatchSize
+        self.maxBatchDelay = maxBatchDelay
+        self.maxQueueDepth = maxQueueDepth
+        self.pool = self.queue = self.batcher = None
+        self.batches = set() # running batch tasks
+        self.poolError = None # why the pool was last replaced, until a batch succeeds on the new one
+        self.poolRestarts = 0
+
+    async def start(self) -> None:
+        """Description: Checks the model file, then starts the worker pool and the batching task (called by `async with`)"""
+        if self.pool is not None:
+            return
+        Tokenizer.load(self.modelPath) # fail here, not in every worker, if the file is not a usable model
+        self.pool = self.createPool()
+        self.queue = asyncio.Queue(maxsize=self.maxQueueDepth)
+        self.slots = asyncio.Semaphore(2 * self.numWorkers)
+        self.batcher = asyncio.create_task(self.collectBatches())
+        logger.info("[Thoth => service]: Serving %s with %d workers.", self.modelPath, self.numWorkers)
+
+    async def close(self) -> None:
+        """Description: Stops batching, fails the requests still queued, waits for running batches and shuts the pool down"""
+        if self.pool is None:
+            return
+        self.batcher.cancel()
+        try:
+            await self.batcher
+        except asyncio.CancelledError:
+            pass
+        while not self.queue.empty():
+            _, _, future = self.queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError("[Thoth => service]: Service closed."))
+        if self.batches:
+            await asyncio.gather(*self.batches, return_exceptions=True)
+        pool, self.pool = self.pool, None
+        await asyncio.get_running_loop().run_in_executor(None, pool.shutdown)
+
+    async def __aenter__(self) -> "TokenizerService":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *excInfo) -> None:
+        await self.close()
+
+    async def encode(self, text: str) -> list[int]:
+        """Description: Encodes one text in the worker pool, batched with concurrent requests"""
+        return await self.submit("encode", text)
+
+    async def decode(self, ids: list[int]) -> str:
+        """Description: Decodes one id list in the worker pool, batched with concurrent requests"""
+        return await self.submit("decode", ids)
+
+    def health(self) -> dict:
+        """Description: Returns the service status: "ok", or "unhealthy" when it is not running or its pool broke and no batch has succeeded since"""
+        if self.pool is None:
+            return {"status": "unhealthy", "error": "Service not started.", "poolRestarts": self.poolRestarts}
+        if self.poolError is not None:
+            return {"status": "unhealthy", "error": self.poolError, "poolRestarts": self.poolRestarts}
+        return {"status": "ok", "poolRestarts": self.poolRestarts}
+
+    ########################################################
+    ################### HELPER FUNCTIONS ###################
+    ########################################################
+
+    def createPool(self) -> ProcessPoolExecutor:
+        """Description: Returns a new worker pool whose workers each load the model file once"""
+        return ProcessPoolExecutor(max_workers=self.numWorkers, initializer=initServiceWorker, initargs=(self.modelPath,))
+
+    def replacePool(self, pool: ProcessPoolExecutor, error: Exception) -> None:
+        """Description: Replaces `pool` after it broke (e.g. a worker process was killed), unless another batch already did or the service is closing"""
+        self.poolError = f"{type(error).__name__}: {error}"
+        if self.pool is not pool:
+            return
+        self.poolRestarts += 1
+        logger.error("[Thoth => service]: Worker pool broke (%s); starting a new one.", self.poolError)
+        pool.shutdown(wait=False, cancel_futures=True)
+        self.pool = self.createPool()
+
+    async def submit(self, operation: str, item):
+        """Description: Queues one request and waits for its result (raises asyncio.QueueFull when the queue is at `maxQueueDepth`)"""
+        if self.pool is None:
+            raise RuntimeError("[Thoth => service]: Service not started.")
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((operation, item, future))
+        return await future
+
+    async def collectBatches(self) -> None:
+        """Description: Forever takes the next request, adds whatever arrives within `maxBatchDelay` (up to `maxBatchSize`), and starts the batch once a worker slot is free"""
+        loop = asyncio.get_running_loop()
+        queue = self.queue
+        batch = []
+        try:
+            while True:
+                batch = [await queue.get()]
+                deadline = loop.time() + self.maxBatchDelay
+                while len(batch) < self.maxBatchSize:
+                    if not queue.empty():
+                        batch.append(queue.get_nowait())
+                        continue
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                await self.slots.acquire()
+                task = asyncio.create_task(self.runBatch(batch))
+                self.batches.add(task)
+                task.add_done_callback(self.batches.discard)
+                batch = []
+        except asyncio.CancelledError:
+            # Closing: the batch being collected never reached a worker
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(RuntimeError("[Thoth => service]: Service closed."))
+            raise
+
+    async def runBatch(self, batch: list) -> None:
+        """Description: Sends the batch to the pool (one task per operation) and resolves every request's future, replacing the pool if it broke"""
+        loop = asyncio.get_running_loop()
+        pool = self.pool
+        try:
+            groups = {}
+            for request in batch:
+                if not request[2].cancelled():
+                    groups.setdefault(request[0], []).append(request)
+            tasks = {}
+            for operation, requests in groups.items():
+                try:
+                    tasks[operation] = loop.run_in_executor(pool, runServiceBatch, operation, [item for _, item, _ in requests])
+                except Exception as e: # a broken or shut down pool refuses new work right away
+                    tasks[operation] = loop.create_future()
+                    tasks[operation].set_exception(e)
+            for operation, requests in groups.items():
+                try:
+                    results = await tasks[operation]
+                except Exception as e: # e.g. a worker process died; the request itself may be fine
+                    if isinstance(e, BrokenExecutor):
+                        self.replacePool(pool, e)
+                    for _, _, future in requests:
+                        if not future.done():
+                            future.set_exception(RuntimeError(f"[Thoth => service]: Batch failed: {type(e).__name__}: {e}"))
+                    continue
+                if pool is self.pool:
+                    self.poolError = None
+                for (_, _, future), (error, value) in zip(requests, results):
+                    if future.done():
+                        continue
+                    if error is None:
+                        future.set_result(value)
+                    else:
+                        future.set_exception(ValueError(error))
+        finally:
+            self.slots.release()
+
+serviceTokenizer = None # tokenizer of the current service worker process, loaded once by `initServiceWorker`
+
+def initServiceWorker(modelPath: str) -> None:
+    """Description: Process pool initializer; loads the model file once per worker"""
+    global serviceTokenizer
+    serviceTokenizer = Tokenizer.load(modelPath)
+
+def runServiceBatch(operation: str, items: list) -> list[tuple[str, object]]:
+    """Description: Process worker task; runs one operation over a batch, returning an (error message or None, result) pair per item so one bad request does not fail the others"""
+    function = serviceTokenizer.encoder if operation == "encode" else serviceTokenizer.decoder
+    results = []
+    for item in items:
+        try:
+            results.append((None, function(item)))
+        except Exception as e:
+            results.append((str(e), None))
+    return results
+
+###############################################################
+######################### HTTP SERVER #########################
+###############################################################
+
+async def serve(service: TokenizerService, host: str = "127.0.0.1", port: int = 8080, unixPath: str = None) -> asyncio.AbstractServer:
+    """
+    - Starts a minimal HTTP/1.1 server (TCP, or a Unix socket if `unixPath` is given) in front of a started `TokenizerService`.
+    - POST /encode {"text": str} -> {"ids": [int]}; POST /decode {"ids": [int]} -> {"text": str}; GET /health -> `TokenizerService.health()`, with 503 while unhealthy.
+    - Errors come back as {"error": str} with 400 (bad request or tokenizer error), 404, 405, 413, 500 (unexpected error) or 503 (queue full, service closed or worker pool failure).
+    - Connections are kept alive between requests unless the client asks otherwise.
+    """
+    def handler(reader, writer):
+        return handleConnection(service, reader, writer)
+    if unixPath is not None:
+        return await asyncio.start_unix_server(handler, unixPath)
+    return await asyncio.start_server(handler, host, port)
+
+async def handleConnection(service: TokenizerService, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    """Description: Serves the HTTP requests of one connection until it closes"""
+    try:
+        while True:
+            requestLine = await reader.readline()
+            if not requestLine:
+                break
+            parts = requestLine.decode("latin-1").split()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            if len(parts) != 3:
+                await writeResponse(writer, 400, {"error": "Malformed request line."}, keepAlive=False)
+                break
+            method, path, version = parts
+            try:
+                length = int(headers.get("content-length", 0))
+            except ValueError:
+                length = -1
+            if not 0 <= length <= MAX_REQUEST_BYTES:
+                await writeResponse(writer, 413 if length > MAX_REQUEST_BYTES else 400, {"error": "Bad Content-Length."}, keepAlive=False)
+                break
+            body = await reader.readexactly(length) if length else b""
+            status, payload = await routeRequest(service, method, path, body)
+            keepAlive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+            await writeResponse(writer, status, payload, keepAlive)
+            if not keepAlive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+async def routeRequest(service: TokenizerService, method: str, path: str, body: bytes) -> tuple[int, dict]:
+    """Description: Runs one HTTP request against the service, returning (status, JSON payload)"""
+    if path == "/health":
+        if method != "GET":
+            return 405, {"error": "Use GET."}
+        health = service.health()
+        return (200 if health["status"] == "ok" else 503), health
+    if path not in ("/encode", "/decode"):
+        return 404, {"error": f"Unknown path {path}."}
+    if method != "POST":
+        return 405, {"error": "Use POST."}
+    try:
+        request = json.loads(body)
+        if path == "/encode":
+            text = request["text"]
+            if not isinstance(text, str):
+                raise TypeError("text must be a string")
+            return 200, {"ids": await service.encode(text)}
+        ids = request["ids"]
+        if not isinstance(ids, list) or not all(type(idx) is int for idx in ids):
+            raise TypeError("ids must be a list of integers")
+        return 200, {"text": await service.decode(ids)}
+    except asyncio.QueueFull:
+        return 503, {"error": "Queue full, retry later."}
+    except (ValueError, KeyError, TypeError, AttributeError) as e: # bad JSON, missing / mistyped field, or a tokenizer error
+        return 400, {"error": f"{type(e).__name__}: {e}"}
+    except RuntimeError as e: # service closed or batch failed in the pool
+        return 503, {"error": str(e)}
+    except Exception as e:
+        logger.exception("[Thoth => service]: Unexpected error serving %s.", path)
+        return 500, {"error": f"{type(e).__name__}: {e}"}
+
+async def writeResponse(writer: asyncio.StreamWriter, status: int, payload: dict, keepAlive: bool) -> None:
+    """Description: Writes one JSON HTTP response"""
+    body = json.dumps(payload).encode("utf-8")
+    head = (f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keepAlive else 'close'}\r\n\r\n")
+    writer.write(head.encode("latin-1") + body)
+    await writer.drain()
+
+async def runServer(args: argparse.Namespace) -> None:
+    """Description: Runs the service and its HTTP server until cancelled"""
+    service = TokenizerService(args.model, numWorkers=args.workers, maxBatchSize=args.max_batch_size, maxBatchDelay=args.max_batch_delay_ms / 1000, maxQueueDepth=args.max_queue_depth)
+    async with service:
+        server = await serve(service, args.host, args.port, args.unix_socket)
+        print(f"[Thoth => service]: Listening on {args.unix_socket or f'http://{args.host}:{args.port}'}")
+        async with server:
+            await server.serve_forever()
+
+def main(argv: list[str] = None) -> int:
+    """Description: Serves a saved tokenizer over HTTP (see `serve`) until interrupted"""
+    parser = argparse.ArgumentParser(description="Serve a saved Thoth tokenizer over HTTP.")
+    parser.add_argument("--model", required=True, help="model file written by Tokenizer.save")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--unix-socket", help="listen on this Unix socket path instead of TCP")
+    parser.add_argument("--workers", type=int, help="worker processes (default: one per core)")
+    parser.add_argument("--max-batch-size", type=int, default=MAX_BATCH_SIZE, help="requests per worker task")
+    parser.add_argument("--max-batch-delay-ms", type=float, default=MAX_BATCH_DELAY * 1000, help="how long a batch waits to fill up")
+    parser.add_argument("--max-queue-depth", type=int, default=MAX_QUEUE_DEPTH, help="pending requests before answering 503")
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(runServer(args))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
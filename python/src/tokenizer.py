@@ -0,0 +1,258 @@
+"""Shared base class for the tokenizers: functionality that only relies on `encoder` / `decoder`."""
+
+import codecs
+import importlib
+import json
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import utils as util
+from modelFile import readModelFile, writeModelFile
+
+BATCH_EXECUTORS = ("process", "thread")
+BATCH_POOL_UNTRACKED = ("batchPool", "flatVocab", "chunkCache", "wordCache") # attributes whose changes the batch workers need not see (derived data and caches)
+MODEL_VERSION = 1 # version of the sections a saved tokenizer is made of (the container has its own)
+TOKENIZER_MODULES = { # where `Tokenizer.load` finds the class named in a model file
+    "BasicTokenizer": "basicTokenizer",
+    "RegexTokenizer": "regexTokenizer",
+    "GPT4Tokenizer": "gpt4Tokenizer",
+    "Llama2Tokenizer": "llama2Tokenizer",
+}
+
+class Tokenizer:
+    """Base class of BasicTokenizer, RegexTokenizer (and GPT4Tokenizer) and Llama2Tokenizer."""
+
+    metrics = None # metrics sink (see `setMetrics`); None keeps instrumentation off
+    batchPool = None # (key, pool) kept by `encodeBatch` / `decodeBatch` between calls (see `close`)
+
+    def setMetrics(self, metrics) -> None:
+        """
+        - Installs a metrics sink, e.g. `instrumentation.Metrics()`, that receives per-phase timings and counters from `train`, `encoder` and `decoder`; None turns instrumentation off again.
+        - Any object with `count(name, value)` and `observe(name, seconds)` works. While no sink is installed the hot paths only pay a None check.
+        - Process workers of `encodeBatch` / `decodeBatch` record into their own copy of the sink.
+        """
+        self.metrics = metrics
+
+    def encodeBatch(self, texts: list[str], numWorkers: int = None, executor: str = "process", chunkSize: int = 64) -> list[list[int]]:
+        """
+        - Encodes a batch of texts, returning one id list per text in input order.
+        - With `numWorkers` > 1 the texts are spread over a process pool (or a thread pool if `executor` is "thread").
+        - Process workers receive the tokenizer once, through the pool initializer, and then only texts and ids cross process boundaries (`chunkSize` texts per task).
+        - The pool is kept for later batches with the same `numWorkers` and `executor` (a changed tokenizer, e.g. retrained, gets a fresh one); `close()` or a `with` block shuts it down.
+
+        Parameters:
+        - texts (list): The texts to encode.
+        - numWorkers (int, optional): Number of workers; None or 1 encodes in the calling thread.
+        - executor (str): "process" (CPU parallel) or "thread" (shares memory, but bound by the GIL).
+        - chunkSize (int): Number of texts sent to a process worker per task.
+
+        Returns:
+        - list: A list of token id lists.
+        """
+        return self.runBatch(encodeInWorker, self.encoder, texts, numWorkers, executor, chunkSize)
+
+    def decodeBatch(self, idsList: list[list[int]], numWorkers: int = None, executor: str = "process", chunkSize: int = 64) -> list[str]:
+        """
+        - Decodes a batch of id lists, returning one text per id list in input order.
+        - Takes the same execution options as `encodeBatch`.
+        """
+        return self.runBatch(decodeInWorker, self.decoder, idsList, numWorkers, executor, chunkSize)
+
+    def streamDecoder(self) -> "StreamDecoder":
+        """
+        - Returns a stateful decoder for ids that arrive one (or a few) at a time, e.g. token-by-token LLM output.
+        - Each call only decodes the new ids and carries an incomplete UTF-8 sequence over to the next call, so a character split across tokens comes out whole and the total work stays linear in the output.
+        """
+        return StreamDecoder(self.decodeBytes)
+
+    def close(self) -> None:
+        """Description: Shuts down the worker pool kept by `encodeBatch` / `decodeBatch`, if any; a later parallel batch starts a new one"""
+        if self.batchPool is not None:
+            _, pool = self.batchPool
+            self.batchPool = None
+            pool.shutdown()
+
+    def __enter__(self) -> "Tokenizer":
+        return self
+
+    def __exit__(self, *excInfo) -> None:
+        self.close()
+
+    def __getstate__(self) -> dict:
+        """Description: Pickles the tokenizer (e.g. for batch worker processes) without its worker pool"""
+        state = self.__dict__.copy()
+        state.pop("batchPool", None)
+        return state
+
+    def save(self, path: str) -> None:
+        """
+        - Saves the trained tokenizer (merges, vocab, split pattern, special tokens, ...) to a compact, versioned binary file.
+        - Big tables are stored as raw arrays (see `modelFile`), small settings as a JSON metadata section.
+
+        Parameters:
+        - path (str): The path to the model file.
+
+        Returns:
+        - None
+        """
+        metadata, sections = self.modelSections()
+        metadata.update(tokenizerType=type(self).__name__, modelVersion=MODEL_VERSION)
+        sections["metadata"] = json.dumps(metadata).encode("utf-8")
+        writeModelFile(path, sections)
+
+    @classmethod
+    def load(cls, path: str) -> "Tokenizer":
+        """
+        - Loads a tokenizer written by `save`, returning an instance of the class it was saved from (which must be `cls` or a subclass).
+        - The file is memory-mapped and the vocab stays a view into it, so worker processes loading the same file share its pages; only the merges lookup dict is rebuilt.
+
+        Parameters:
+        - path (str): The path to the model file.
+
+        Returns:
+        - Tokenizer: The loaded tokenizer.
+        """
+        _, sections = readModelFile(path)
+        try:
+            metadata = json.loads(bytes(sections["metadata"]))
+            tokenizerType = metadata["tokenizerType"]
+        except (KeyError, ValueError):
+            raise ValueError(f"[Thoth => load]: {path} is not a saved tokenizer.") from None
+        if metadata.get("modelVersion") != MODEL_VERSION:
+            raise ValueError(f"[Thoth => load]: {path} has model version {metadata.get('modelVersion')}, expected {MODEL_VERSION}.")
+        if tokenizerType not in TOKENIZER_MODULES:
+            raise ValueError(f"[Thoth => load]: {path} holds an unknown tokenizer type {tokenizerType!r}.")
+        tokenizerClass = getattr(importlib.import_module(TOKENIZER_MODULES[tokenizerType]), tokenizerType)
+        if not issubclass(tokenizerClass, cls):
+            raise ValueError(f"[Thoth => load]: {path} holds a {tokenizerType}, not a {cls.__name__}.")
+        tokenizer = tokenizerClass.__new__(tokenizerClass)
+        try:
+            tokenizer.loadSections(metadata, sections)
+        except KeyError as e:
+            raise ValueError(f"[Thoth => load]: {path} is missing section {e}.") from None
+        return tokenizer
+
+    def getFlatVocab(self) -> util.FlatVocab:
+        """Description: Returns the flat (blob + offsets) form of `self.vocab`, rebuilding it whenever the vocab changed"""
+        if isinstance(self.vocab, util.FlatVocab):
+            return self.vocab # loaded straight from a model file
+        flatVocab = getattr(self, "flatVocab", None)
+        if flatVocab is None or flatVocab.source is not self.vocab or flatVocab.numEntries != len(self.vocab):
+            flatVocab = self.flatVocab = util.FlatVocab(self.vocab)
+        return flatVocab
+
+    ########################################################
+    ################### HELPER FUNCTIONS ###################
+    ########################################################
+
+    def decodeBytes(self, ids) -> bytes:
+        """Description: Returns the joined bytes behind `ids` (subclasses override this to handle special ids or substituted bytes)"""
+        return self.getFlatVocab().gather(ids)
+
+    def recordCall(self, operation: str, started: float, numTokens: int, numBytes: int) -> None:
+        """Description: Reports one finished encode / decode call (started at `started`, from `time.perf_counter`) to the metrics sink"""
+        metrics = self.metrics
+        metrics.observe(operation + ".total", time.perf_counter() - started)
+        metrics.count(operation + ".tokens", numTokens)
+        metrics.count(operation + ".bytes", numBytes)
+
+    def modelSections(self) -> tuple[dict, dict]:
+        """Description: Returns the (metadata, binary sections) `save` writes; byte-level BPE tokenizers store their merges and flat vocab"""
+        flatVocab = self.getFlatVocab()
+        sections = {"merges": packMerges(self.mints), "vocabOffsets": flatVocab.offsets, "vocabBlob": flatVocab.blob}
+        return {}, sections
+
+    def loadSections(self, metadata: dict, sections: dict) -> None:
+        """Description: Restores the state written by `modelSections` (called by `load` on an instance created without __init__)"""
+        self.mints = unpackMerges(sections["merges"])
+        self.vocab = util.FlatVocab.fromBuffers(sections["vocabBlob"], sections["vocabOffsets"])
+
+    def runBatch(self, workerFunction, localFunction, items: list, numWorkers: int, executor: str, chunkSize: int) -> list:
+        """Description: Maps `localFunction` over the items in this thread, a thread pool, or a process pool initialized with this tokenizer"""
+        if executor not in BATCH_EXECUTORS:
+            raise ValueError(f"[Thoth => batch]: Unknown executor {executor!r}, expected one of {BATCH_EXECUTORS}.")
+        if numWorkers is None or numWorkers <= 1 or len(items) <= 1:
+            return [localFunction(item) for item in items]
+        pool = self.getBatchPool(executor, numWorkers)
+        if executor == "thread":
+            return list(pool.map(localFunction, items))
+        return list(pool.map(workerFunction, items, chunksize=max(1, chunkSize)))
+
+    def getBatchPool(self, executor: str, numWorkers: int):
+        """Description: Returns the kept batch pool, first replacing it if it was started with other options or before the tokenizer changed (process workers hold a copy of it)"""
+        key = (executor, numWorkers, tuple(
+            (name, id(value), len(value) if isinstance(value, (dict, list)) else None)
+            for name, value in self.__dict__.items() if name not in BATCH_POOL_UNTRACKED
+        ))
+        if self.batchPool is not None and self.batchPool[0] == key:
+            return self.batchPool[1]
+        self.close()
+        if executor == "thread":
+            pool = ThreadPoolExecutor(max_workers=numWorkers)
+        else:
+            pool = ProcessPoolExecutor(max_workers=numWorkers, initializer=initTokenizerWorker, initargs=(self,))
+        self.batchPool = (key, pool)
+        return pool
+
+class StreamDecoder:
+    """
+    - Incremental decoder returned by `Tokenizer.streamDecoder`.
+    - `decode` maps the new ids to bytes and feeds them through an incremental UTF-8 decoder; the bytes of a character that is not complete yet are held until the next call.
+    - Concatenating every `decode` result and `flush` gives the same text as `decoder` on all the ids (invalid bytes become U+FFFD).
+    - `textReplace` is an optional (old, new) pair replaced in the decoded text (e.g. Llama2's "▁" -> " "); it is applied to whole characters, so it works however the ids split them.
+    - `dropPrefix` (e.g. Llama2's dummy space) is removed once from the start of the stream if the text starts with it.
+    """
+
+    def __init__(self, decodeBytes, dropPrefix: str = "", textReplace: tuple[str, str] = None) -> None:
+        self.decodeBytes = decodeBytes
+        self.utf8Decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.dropPrefix = self.pendingPrefix = dropPrefix
+        self.textReplace = textReplace
+
+    def decode(self, ids) -> str:
+        """Description: Decodes the next id (an int) or ids, returning the text that is complete so far (possibly empty)"""
+        if isinstance(ids, int):
+            ids = (ids,)
+        text = self.utf8Decoder.decode(self.decodeBytes(ids))
+        if self.textReplace is not None:
+            text = text.replace(*self.textReplace)
+        if self.pendingPrefix and text:
+            if text.startswith(self.pendingPrefix):
+                text = text[len(self.pendingPrefix):]
+            self.pendingPrefix = ""
+        return text
+
+    def flush(self) -> str:
+        """Description: Ends the stream, returning any held back bytes (an incomplete character becomes U+FFFD) and resetting the decoder"""
+        text = self.utf8Decoder.decode(b"", final=True)
+        self.utf8Decoder.reset()
+        self.pendingPrefix = self.dropPrefix
+        return text
+
+def packMerges(merges: dict[tuple[int, int], int]) -> array:
+    """Description: Flattens a (int, int) -> int merges dict into a uint32 array of (left, right, merged) triples"""
+    packed = array("I")
+    for (p0, p1), idx in merges.items():
+        packed.extend((p0, p1, idx))
+    return packed
+
+def unpackMerges(packed) -> dict[tuple[int, int], int]:
+    """Description: Inverse of `packMerges` (accepts the array or a memoryview of a model file section)"""
+    packed = memoryview(packed).cast("B").cast("I")
+    return dict(zip(zip(packed[0::3], packed[1::3]), packed[2::3]))
+
+workerTokenizer = None # tokenizer of the current worker process, set once by `initTokenizerWorker`
+
+def initTokenizerWorker(tokenizer: Tokenizer) -> None:
+    """Description: Process pool initializer; installs the tokenizer state in the worker once"""
+    global workerTokenizer
+    workerTokenizer = tokenizer
+
+def encodeInWorker(text: str) -> list[int]:
+    """Description: Process worker task; encodes one text with the worker's tokenizer"""
+    return workerTokenizer.encoder(text)
+
+def decodeInWorker(ids: list[int]) -> str:
+    """Description: Process worker task; decodes one id list with the worker's tokenizer"""
+    return workerTokenizer.decoder(ids)
@@ -1,12 +1,41 @@
+import codecs
+import heapq
+import mmap
+import os
+import re
 import unicodedata
+from array import array
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import accumulate, groupby
+
+try:
+    import numpy as np
+except ImportError: # NumPy is optional; pure Python paths are used without it
+    np = None
+
+CORPUS_PIECE_SIZE = 1 << 20 # characters (or bytes) read from a corpus source at a time
+CORPUS_SHARD_SIZE = 1 << 22 # characters handed to a worker process at a time
+CHUNK_CACHE_SIZE = 1 << 16 # default number of chunk encodings kept per tokenizer
+CHUNK_CACHE_MAX_LENGTH = 256 # longer chunks are rarely repeated and are never cached, which caps the cache's memory
+VECTORIZED_GATHER_MIN_IDS = 128 # below this a plain join of blob slices beats NumPy's per-call overhead
+VECTORIZED_PAIRS_MIN_IDS = 4096 # below this the pure Python pair counting / merging beats NumPy's conversion overhead
+ID_OUTPUT_TYPES = ("list", "array", "memoryview", "numpy") # containers an encoder can return its ids in
+LINE_SPLIT_PATTERN = re.compile(r"[^\n]*\n|[^\n]+") # used when a tokenizer has no split pattern of its own
+SPLIT_STREAM_LOOKAHEAD = 8 # characters past a match its alternatives may need to see (the contraction alternatives look 2 past a lone "'")
+WHITESPACE_SWITCH = re.compile(r"(?<=\S)(?=\s)|(?<=\s)(?=\S)") # candidate shard cuts (see `findShardBoundary`)
+SHARD_CHECK_WINDOW = 1024 # characters split on either side of a candidate shard cut to check it
 
 ###############################################################
 ################### SHARED HELPER FUNCTIONS ###################
 ###############################################################
 
 def countCommonEncodedTuples(encodedInts: list[int], freqDict: dict[tuple[int, int], int] = None) -> None:
-    """Description: Returns most common tuples of encoded integers and their frequency of occurence"""
+    """Description: Returns most common tuples of encoded integers and their frequency of occurence (counted with NumPy for long sequences when available)"""
     freqDict = {} if freqDict is None else freqDict
+    if np is not None and len(encodedInts) >= VECTORIZED_PAIRS_MIN_IDS:
+        return countPairsVectorized(encodedInts, freqDict)
     for i in range(len(encodedInts) - 1):
         pair = (encodedInts[i], encodedInts[i + 1])
         freqDict[pair] = freqDict.get(pair, 0) + 1 
@@ -14,7 +43,9 @@ def countCommonEncodedTuples(encodedInts: list[int], freqDict: dict[tuple[int, i
     return freqDict
 
 def merge(pair, ids: list[int], idx: int) -> list[int]:
-    """Description: Removes a tuple of integers from a list of integers"""
+    """Description: Removes a tuple of integers from a list of integers (with a NumPy pass for long sequences when available)"""
+    if np is not None and len(ids) >= VECTORIZED_PAIRS_MIN_IDS:
+        return mergeVectorized(pair, ids, idx)
     mergedIDs, i = [], 0 
 
     while i < len(ids):
@@ -26,6 +57,570 @@ def merge(pair, ids: list[int], idx: int) -> list[int]:
             i += 1 
     return mergedIDs
 
+def pairKeys(ids) -> "np.ndarray":
+    """Description: Packs every adjacent pair of a non-negative id sequence into one int64 key (left id in the high 32 bits)"""
+    ids = np.asarray(ids, dtype=np.int64)
+    return (ids[:-1] << 32) | ids[1:]
+
+def unpackPairKey(key: int) -> tuple[int, int]:
+    """Description: Inverse of `pairKeys` for a single key"""
+    return key >> 32, key & 0xFFFFFFFF
+
+def countPairsVectorized(encodedInts, freqDict: dict[tuple[int, int], int] = None) -> dict[tuple[int, int], int]:
+    """Description: NumPy version of `countCommonEncodedTuples`: counts the packed pair keys with `np.unique` and adds them to `freqDict`"""
+    freqDict = {} if freqDict is None else freqDict
+    if len(encodedInts) < 2:
+        return freqDict
+    keys, counts = np.unique(pairKeys(encodedInts), return_counts=True)
+    for key, count in zip(keys.tolist(), counts.tolist()):
+        pair = unpackPairKey(key)
+        freqDict[pair] = freqDict.get(pair, 0) + count
+    return freqDict
+
+def mergeVectorized(pair, ids, idx: int):
+    """
+    - NumPy version of `merge`: marks every occurrence of `pair`, writes `idx` at the kept ones and compacts the right halves away in one pass.
+    - Overlapping occurrences (runs of `(a, a)`) are resolved like the left-to-right loop: within a run of consecutive matches only every other one, starting with the first, is merged.
+    - Returns a list for list input and a NumPy array for NumPy input.
+    """
+    arr = np.asarray(ids, dtype=np.int64)
+    if len(arr) < 2:
+        return ids if isinstance(ids, np.ndarray) else list(ids)
+    first, second = pair
+    matches = (arr[:-1] == first) & (arr[1:] == second)
+    if first == second:
+        # A match that directly follows another match overlaps it; keep even offsets within each run of matches
+        positions = np.arange(len(matches))
+        runStarts = matches & ~np.concatenate(([False], matches[:-1]))
+        runStart = np.maximum.accumulate(np.where(runStarts, positions, 0))
+        matches &= (positions - runStart) % 2 == 0
+    merged = arr.copy()
+    merged[:-1][matches] = idx
+    keep = np.ones(len(arr), dtype=bool)
+    keep[1:][matches] = False
+    merged = merged[keep]
+    return merged if isinstance(ids, np.ndarray) else merged.tolist()
+
+def indexPairs(ids: list[int], nxt: list[int], weight: list[int]) -> tuple[dict[tuple[int, int], int], dict[tuple[int, int], set[int]]]:
+    """
+    - Builds BPE training's pair -> weighted count and pair -> set of left positions indexes over flattened chunks, where `nxt[pos]` is -1 at the end of a chunk (and `pos` + 1 elsewhere).
+    - With NumPy (and enough ids) the pairs are packed into int64 keys, sorted, and counted per run of equal keys with `np.add.reduceat`; Python only touches each unique pair once.
+    """
+    pairCounts, pairPositions = {}, {}
+    n = len(ids)
+    if np is None or n < VECTORIZED_PAIRS_MIN_IDS:
+        for pos in range(n - 1):
+            if nxt[pos] != -1:
+                pair = (ids[pos], ids[pos + 1])
+                pairCounts[pair] = pairCounts.get(pair, 0) + weight[pos]
+                pairPositions.setdefault(pair, set()).add(pos)
+        return pairCounts, pairPositions
+
+    positions = np.flatnonzero(np.asarray(nxt[:-1], dtype=np.int64) != -1)
+    keys = pairKeys(ids)[positions]
+    order = np.argsort(keys) # positions end up in sets, so the sort need not be stable
+    keys, positions = keys[order], positions[order]
+    if len(keys) == 0:
+        return pairCounts, pairPositions
+    starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+    counts = np.add.reduceat(np.asarray(weight, dtype=np.int64)[positions], starts)
+    ends = np.append(starts[1:], len(keys))
+    positions = positions.tolist()
+    for key, count, start, end in zip(keys[starts].tolist(), counts.tolist(), starts.tolist(), ends.tolist()):
+        pair = unpackPairKey(key)
+        pairCounts[pair] = count
+        pairPositions[pair] = set(positions[start:end])
+    return pairCounts, pairPositions
+
+def applyMerges(ids: list[int], mints: dict[tuple[int, int], int]) -> list[int]:
+    """
+    - Encodes a sequence of ids with trained merges, applying them in rank order (a merged token's id is its rank).
+    - The ids live in a linked list and the candidate pairs in a min-heap of (rank, position), so each merge only re-ranks its two new neighbours: O(n log n) per chunk instead of a full recount per merge.
+    - Equal ranks pop left to right, which reproduces the non-overlapping left-to-right merging of `merge`, so the output matches repeatedly merging the lowest ranked pair.
+    """
+    ids = list(ids)
+    n = len(ids)
+    if n < 2:
+        return ids
+    nxt = list(range(1, n + 1))
+    nxt[-1] = -1
+    prev = list(range(-1, n - 1))
+    heap = []
+    for i in range(n - 1):
+        rank = mints.get((ids[i], ids[i + 1]))
+        if rank is not None:
+            heap.append((rank, i))
+    heapq.heapify(heap)
+
+    while heap:
+        rank, i = heapq.heappop(heap)
+        j = nxt[i]
+        # Skip entries whose pair was changed by an earlier merge
+        if j == -1 or ids[i] == -1 or mints.get((ids[i], ids[j])) != rank:
+            continue
+        ids[i], ids[j] = rank, -1
+        k = nxt[j]
+        nxt[i] = k
+        if k != -1:
+            prev[k] = i
+            newRank = mints.get((rank, ids[k]))
+            if newRank is not None:
+                heapq.heappush(heap, (newRank, i))
+        p = prev[i]
+        if p != -1:
+            newRank = mints.get((ids[p], rank))
+            if newRank is not None:
+                heapq.heappush(heap, (newRank, p))
+
+    # The head never merges away (merges always drop the right node)
+    encoded, i = [], 0
+    while i != -1:
+        encoded.append(ids[i])
+        i = nxt[i]
+    return encoded
+
+def countChunkFrequencies(texts, compiledPattern, chunkCounts: dict[bytes, int] = None) -> dict[bytes, int]:
+    """Description: Splits each text with the compiled pattern and tallies how often every unique chunk (as UTF-8 bytes) occurs"""
+    chunkCounts = {} if chunkCounts is None else chunkCounts
+    for text in texts:
+        for chunk in compiledPattern.findall(text):
+            key = chunk.encode("utf-8")
+            chunkCounts[key] = chunkCounts.get(key, 0) + 1
+    # {} [K, V] -> [chunk bytes, frequency]
+    return chunkCounts
+
+def readCorpus(source, pieceSize: int = CORPUS_PIECE_SIZE):
+    """
+    - Yields one corpus source as str pieces of bounded size, so the whole corpus never has to be held in one string.
+    - `str` sources are already-loaded text and are yielded as is.
+    - `os.PathLike` sources (e.g. `pathlib.Path("data/taylorSwift.txt")`) are memory-mapped and decoded piece by piece.
+    - File objects (text or binary) are read `pieceSize` at a time.
+    - Bytes-like sources (bytes, bytearray, memoryview, mmap) are sliced without copying.
+    - Any other iterable is treated as one document made of str or bytes pieces (e.g. chunks off a socket).
+    - Bytes are decoded incrementally, so a UTF-8 character split across pieces is reassembled; invalid bytes become U+FFFD.
+    """
+    if isinstance(source, str):
+        yield source
+        return
+
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    if isinstance(source, os.PathLike):
+        with open(source, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                yield from readCorpus(mm, pieceSize)
+        return
+    if hasattr(source, "read"):
+        pieces = iter(lambda: source.read(pieceSize), source.read(0))
+    elif isinstance(source, (bytes, bytearray, memoryview, mmap.mmap)):
+        with memoryview(source) as view:
+            for start in range(0, len(view), pieceSize):
+                piece = decoder.decode(view[start:start + pieceSize])
+                if piece:
+                    yield piece
+        pieces = ()
+    else:
+        pieces = source
+
+    for piece in pieces:
+        piece = piece if isinstance(piece, str) else decoder.decode(piece)
+        if piece:
+            yield piece
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+def splitStream(pieces, compiledPattern):
+    """
+    - Splits a stream of str pieces into the same chunks `compiledPattern.findall` would produce on their concatenation.
+    - Matches ending within `SPLIT_STREAM_LOOKAHEAD` characters of the buffer end are held back (they may still grow or re-split once more text arrives, e.g. "'" before "ve") and re-scanned with the text that follows.
+    - New pieces are collected until they are at least as long as the held-back text, so a long run (e.g. a huge word or whitespace block) is re-scanned only each time it doubles and the work stays linear.
+    - Only the held-back text and the pieces collected after it are kept in memory.
+    """
+    buffer, pending, pendingSize = "", [], 0
+    for piece in pieces:
+        pending.append(piece)
+        pendingSize += len(piece)
+        if pendingSize < len(buffer):
+            continue
+        buffer += "".join(pending)
+        pending, pendingSize = [], 0
+        final, start = len(buffer) - SPLIT_STREAM_LOOKAHEAD, 0
+        for match in compiledPattern.finditer(buffer):
+            if match.end() > final:
+                break
+            yield match.group()
+            start = match.end()
+        buffer = buffer[start:]
+    buffer += "".join(pending)
+    if buffer:
+        yield from compiledPattern.findall(buffer)
+
+def corpusSources(sources):
+    """
+    - Returns the streaming trainers' `sources` argument as an iterable of sources (see `readCorpus`), each one a separate document.
+    - One path, file object, str or bytes-like object is a single source; any other iterable yields its items as sources (e.g. paths, or the str lines of a file).
+    - Consecutive bytes / bytearray / memoryview items are one source, a byte stream: a UTF-8 character or a word split across two reads is reassembled.
+    - Sources must be consumed in order (the byte streams are groups of one shared iterator).
+    """
+    if isinstance(sources, (str, bytes, bytearray, memoryview, mmap.mmap, os.PathLike)) or hasattr(sources, "read"):
+        return [sources]
+    return byteStreamSources(sources)
+
+def byteStreamSources(sources):
+    """Description: Yields the items of `sources`, with each run of consecutive bytes-like items grouped into one source (see `corpusSources`)"""
+    for isByteChunk, group in groupby(sources, key=lambda source: isinstance(source, (bytes, bytearray, memoryview))):
+        if isByteChunk:
+            yield group
+        else:
+            yield from group
+
+def countStreamChunks(sources, compiledPattern, chunkCounts: dict[bytes, int] = None, maxUniqueChunks: int = None, pieceSize: int = CORPUS_PIECE_SIZE, numWorkers: int = None) -> dict[bytes, int]:
+    """
+    - Streams every source (see `corpusSources` and `readCorpus`) through `splitStream` and tallies unique chunks as UTF-8 bytes -> count.
+    - Chunks never span two sources, so passing the str lines of a file treats each line as its own document, while a stream of bytes reads is split as one text.
+    - If `maxUniqueChunks` is set, the table is pruned to its most frequent half whenever it grows past that size, which bounds memory on corpora larger than RAM (at the cost of forgetting rare chunks).
+    - If `numWorkers` > 1, splitting and counting run in a process pool (see `countStreamChunksParallel`).
+    """
+    chunkCounts = {} if chunkCounts is None else chunkCounts
+    sources = corpusSources(sources)
+    if numWorkers is not None and numWorkers > 1:
+        return countStreamChunksParallel(sources, compiledPattern, chunkCounts, maxUniqueChunks, pieceSize, numWorkers)
+    for source in sources:
+        for chunk in splitStream(readCorpus(source, pieceSize), compiledPattern):
+            key = chunk.encode("utf-8")
+            chunkCounts[key] = chunkCounts.get(key, 0) + 1
+            if maxUniqueChunks is not None and len(chunkCounts) > maxUniqueChunks:
+                pruneChunkCounts(chunkCounts, maxUniqueChunks // 2)
+    return chunkCounts
+
+def pruneChunkCounts(chunkCounts: dict[bytes, int], keep: int) -> None:
+    """Description: Keeps only the `keep` most frequent chunks of a chunk -> count table (in place)"""
+    if len(chunkCounts) <= keep:
+        return
+    kept = {chunk: chunkCounts[chunk] for chunk in heapq.nlargest(keep, chunkCounts, key=chunkCounts.get)}
+    chunkCounts.clear()
+    chunkCounts.update(kept)
+
+###############################################################
+#################### COMPACT ID STORAGE #######################
+###############################################################
+
+def newIdBuffer(outputType: str, vocabSize: int):
+    """Description: Returns an empty container for encoder output: a list, or an array('H') / array('I') sized to the vocab"""
+    if outputType not in ID_OUTPUT_TYPES:
+        raise ValueError(f"[Thoth => encoder]: Unknown outputType {outputType!r}, expected one of {ID_OUTPUT_TYPES}.")
+    if outputType == "numpy" and np is None:
+        raise ImportError("[Thoth => encoder]: outputType 'numpy' requires NumPy.")
+    if outputType == "list":
+        return []
+    return array("H" if vocabSize <= 1 << 16 else "I")
+
+def finishIds(ids, outputType: str):
+    """Description: Wraps a buffer from `newIdBuffer` as the requested output type (zero-copy for memoryview and numpy)"""
+    if outputType == "memoryview":
+        return memoryview(ids)
+    if outputType == "numpy":
+        return np.frombuffer(ids, dtype=np.uint16 if ids.typecode == "H" else np.uint32)
+    return ids
+
+def packIds(ids: list[int], outputType: str, vocabSize: int):
+    """Description: Converts a list of ids to the requested output type"""
+    if outputType == "list":
+        return ids
+    buffer = newIdBuffer(outputType, vocabSize)
+    buffer.extend(ids)
+    return finishIds(buffer, outputType)
+
+class FlatVocab(Mapping):
+    """
+    - Flat, read-only form of a vocab dict[int, bytes]: every token's bytes back to back in one blob plus an offsets array (token i is `blob[offsets[i]:offsets[i + 1]]`).
+    - Avoids a Python bytes object and dict entry per token, and decodes a whole id sequence with a single gather-and-join.
+    - The blob and offsets can also be views into a memory-mapped model file (see `fromBuffers`), in which case nothing is copied.
+    - Ids are gathered straight from the blob: with NumPy in one vectorized pass (any id container of at least `VECTORIZED_GATHER_MIN_IDS` ids), otherwise by joining its slices; no per-token objects are kept, so a memory-mapped blob stays shared between processes.
+    """
+
+    def __init__(self, vocab: dict[int, bytes]) -> None:
+        self.source = vocab # the dict this was built from, so owners can tell when it went stale
+        self.numEntries = len(vocab)
+        self.size = max(vocab) + 1 if vocab else 0 # one past the largest id
+        tokens = [vocab.get(idx, b"") for idx in range(self.size)]
+        self.blob = b"".join(tokens)
+        self.offsets = array("Q", [0])
+        self.offsets.extend(accumulate(len(token) for token in tokens))
+        self.arrays = None # NumPy views of (blob, offsets), built on first use by the vectorized gather
+
+    @classmethod
+    def fromBuffers(cls, blob, offsets) -> "FlatVocab":
+        """Description: Wraps an existing blob and uint64 offsets buffer (e.g. sections of a memory-mapped model file) without copying"""
+        flatVocab = cls.__new__(cls)
+        flatVocab.blob = blob
+        flatVocab.offsets = memoryview(offsets).cast("B").cast("Q")
+        flatVocab.size = len(flatVocab.offsets) - 1
+        flatVocab.numEntries = sum(1 for idx in range(flatVocab.size) if flatVocab.offsets[idx] != flatVocab.offsets[idx + 1])
+        flatVocab.source = flatVocab
+        flatVocab.arrays = None
+        return flatVocab
+
+    def __getstate__(self) -> dict:
+        # Memory-mapped views cannot be pickled; ship plain copies and let the gather caches rebuild
+        state = self.__dict__.copy()
+        state.update(blob=bytes(self.blob), offsets=array("Q", self.offsets), arrays=None)
+        if self.source is self:
+            state["source"] = None
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        if self.source is None:
+            self.source = self
+
+    def __len__(self) -> int:
+        return self.numEntries
+
+    def __iter__(self):
+        offsets = self.offsets
+        return (idx for idx in range(self.size) if offsets[idx] != offsets[idx + 1])
+
+    def __getitem__(self, idx: int) -> bytes:
+        if not isinstance(idx, int) or not 0 <= idx < self.size or self.offsets[idx] == self.offsets[idx + 1]:
+            raise KeyError(idx)
+        return bytes(self.blob[self.offsets[idx]:self.offsets[idx + 1]])
+
+    def gather(self, ids) -> bytes:
+        """Description: Returns the concatenated bytes of `ids` (a list, array, memoryview or NumPy array); raises ValueError on unknown ids"""
+        if len(ids) == 0:
+            return b""
+        if np is not None and len(ids) >= VECTORIZED_GATHER_MIN_IDS:
+            return self.gatherVectorized(ids)
+        if np is not None and isinstance(ids, np.ndarray):
+            ids = ids.tolist()
+        blob, offsets = self.blob, self.offsets
+        try:
+            if min(ids) < 0:
+                raise IndexError
+            parts = [blob[offsets[idx]:offsets[idx + 1]] for idx in ids]
+            if not all(parts):
+                raise IndexError
+        except (IndexError, TypeError):
+            idx = next(idx for idx in ids if not isinstance(idx, int) or not 0 <= idx < self.size or offsets[idx] == offsets[idx + 1])
+            raise ValueError(f"invalid token id: {idx}") from None
+        return b"".join(parts)
+
+    def gatherVectorized(self, ids) -> bytes:
+        """Description: NumPy gather: expands every id into the blob positions of its bytes and takes them in one indexing pass"""
+        if self.arrays is None:
+            self.arrays = (np.frombuffer(self.blob, dtype=np.uint8), np.frombuffer(self.offsets, dtype=np.int64))
+        blob, offsets = self.arrays
+        ids = np.asarray(ids, dtype=np.int64) if not isinstance(ids, np.ndarray) else ids
+        if ids.min() < 0 or ids.max() >= self.size:
+            raise ValueError(f"invalid token id: {int(ids[(ids < 0) | (ids >= self.size)][0])}")
+        ids = ids.astype(np.int64, copy=False)
+        starts = offsets[ids]
+        lengths = offsets[ids + 1] - starts
+        if not lengths.all():
+            raise ValueError(f"invalid token id: {int(ids[lengths == 0][0])}")
+        ends = np.cumsum(lengths)
+        positions = np.repeat(starts - (ends - lengths), lengths) + np.arange(int(ends[-1]))
+        return blob[positions].tobytes()
+
+###############################################################
+######################## CHUNK CACHING ########################
+###############################################################
+
+class LRUCache:
+    """
+    - Size-bounded least-recently-used cache, used by the regex-based tokenizers to map a chunk to its token ids.
+    - Holds at most `maxSize` entries (evicting the least recently used one) and skips keys longer than `maxKeyLength`, so memory stays capped on adversarial input.
+    - Tracks hits, misses and evictions.
+    """
+
+    def __init__(self, maxSize: int = CHUNK_CACHE_SIZE, maxKeyLength: int = CHUNK_CACHE_MAX_LENGTH) -> None:
+        assert (maxSize > 0)
+        self.maxSize = maxSize
+        self.maxKeyLength = maxKeyLength
+        self.entries = OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key):
+        """Description: Returns the cached value for `key` (marking it recently used), or None"""
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        try:
+            self.entries.move_to_end(key)
+        except KeyError:
+            pass # evicted by another thread in between (batch encoding with a thread pool)
+        return value
+
+    def put(self, key, value) -> None:
+        """Description: Caches `value` under `key`, evicting the least recently used entry when full"""
+        if len(key) > self.maxKeyLength:
+            return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxSize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        """Description: Drops every entry and resets the counters"""
+        self.entries.clear()
+        self.hits = self.misses = self.evictions = 0
+
+    def stats(self) -> dict[str, int]:
+        """Description: Returns the hit, miss and eviction counters along with the current and maximum size"""
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "size": len(self.entries), "maxSize": self.maxSize}
+
+###############################################################
+################### SPECIAL TOKEN MATCHING ####################
+###############################################################
+
+class SpecialTokenMatcher:
+    """
+    - Finds special tokens (e.g. <|endoftext|>, FIM or chat-control tokens) in text in a single left-to-right pass.
+    - A character class of the tokens' first characters jumps (in C) to the positions where a token can start; a character trie is walked from there, so the cost does not grow with the number of tokens the way an alternation regex does.
+    - Matches never overlap: the leftmost match wins, and the longest token wins among those starting at the same position.
+    """
+
+    def __init__(self, tokens) -> None:
+        self.trie = {} # char -> child node; the None key marks the end of a token
+        for token in tokens:
+            if len(token) == 0:
+                raise ValueError("[Thoth => SpecialTokenMatcher]: Special tokens cannot be empty.")
+            node = self.trie
+            for char in token:
+                node = node.setdefault(char, {})
+            node[None] = token
+        self.startPattern = re.compile("[" + "".join(re.escape(char) for char in self.trie) + "]") if self.trie else None
+
+    def finditer(self, text: str):
+        """Description: Yields (start, end, token) for every special token in `text`, in order"""
+        if self.startPattern is None:
+            return
+        search, trie, n = self.startPattern.search, self.trie, len(text)
+        pos = 0
+        while (m := search(text, pos)) is not None:
+            start = m.start()
+            node, i, end = trie, start, -1
+            while i < n and (node := node.get(text[i])) is not None:
+                i += 1
+                if None in node:
+                    end, token = i, node[None]
+            if end == -1:
+                pos = start + 1
+                continue
+            yield start, end, token
+            pos = end
+
+###############################################################
+################## PARALLEL TRAINING HELPERS ##################
+###############################################################
+
+workerPattern = None # split pattern of the current worker process, set once by `initChunkWorker`
+
+def initChunkWorker(compiledPattern) -> None:
+    """Description: Process pool initializer; ships the split pattern to each worker once instead of with every shard"""
+    global workerPattern
+    workerPattern = compiledPattern
+
+def countShardChunks(shard: str) -> dict[bytes, int]:
+    """Description: Worker task; splits one shard and returns its partial chunk -> count table"""
+    return countChunkFrequencies([shard], workerPattern)
+
+def isSafeCut(text: str, cut: int, compiledPattern) -> bool:
+    """Description: Returns whether the pattern splits the text around `cut` (`SHARD_CHECK_WINDOW` characters either side) into the same chunks with and without a cut there"""
+    left = text[max(cut - SHARD_CHECK_WINDOW, 0):cut]
+    right = text[cut:cut + SHARD_CHECK_WINDOW]
+    return compiledPattern.findall(left) + compiledPattern.findall(right) == compiledPattern.findall(left + right)
+
+def findShardBoundary(text: str, start: int, compiledPattern, maxCandidates: int = 64) -> int:
+    """
+    - Returns the first position at or after `start` where `text` can be cut without changing its chunks, or 0 if none is found (yet).
+    - Candidates are switches between whitespace and non-whitespace (so LF and CRLF line ends and blank lines all qualify), tried in order; each one is checked with `isSafeCut`, so the cut fits whichever split pattern is used.
+    - Candidates closer than `SHARD_CHECK_WINDOW` to the end of `text` are left for when more text has arrived; at most `maxCandidates` are tried.
+    """
+    for tried, match in enumerate(WHITESPACE_SWITCH.finditer(text, max(start, 1), len(text) - SHARD_CHECK_WINDOW)):
+        if tried >= maxCandidates:
+            break
+        if isSafeCut(text, match.start(), compiledPattern):
+            return match.start()
+    return 0
+
+def hardShardCut(text: str, start: int, compiledPattern, maxCandidates: int = 64) -> int:
+    """Description: Returns the last regex chunk start of `text[start:]` that `isSafeCut` accepts (as an index into `text`), or 0 if there is none; the last chunk is always held back, like in `splitStream`"""
+    chunkStarts = [start + match.start() for match in compiledPattern.finditer(text[start:])]
+    for cut in reversed(chunkStarts[-1 - maxCandidates:-1]):
+        if cut > start and isSafeCut(text, cut, compiledPattern):
+            return cut
+    return 0
+
+def shardStream(pieces, compiledPattern, shardSize: int = CORPUS_SHARD_SIZE):
+    """
+    - Regroups a stream of str pieces into shards of about `shardSize` characters that split into the same chunks as the whole stream.
+    - Each shard ends at the first `findShardBoundary` position at or after `shardSize`, so one large piece (e.g. a whole `str` corpus) is cut into many shards.
+    - Text without such boundaries (e.g. one long run without whitespace) is hard cut at a regex chunk start (see `hardShardCut`) once it reaches twice `shardSize`.
+    - About two shards of text are buffered at a time, and resumed searches never rescan text, so the work stays linear in the corpus.
+    """
+    buffer, pending, pendingSize = "", [], 0
+    scanned = 0 # boundary search resumes here: no boundary was found before it
+    hardCutSize = 2 * shardSize # buffered length at which a hard cut is tried
+    for piece in pieces:
+        pending.append(piece)
+        pendingSize += len(piece)
+        if len(buffer) + pendingSize < shardSize:
+            continue
+        buffer += "".join(pending)
+        pending, pendingSize = [], 0
+        start = 0
+        while len(buffer) - start >= shardSize:
+            cut = findShardBoundary(buffer, max(start + shardSize, scanned), compiledPattern)
+            if cut == 0 and len(buffer) - start >= hardCutSize:
+                cut = hardShardCut(buffer, start, compiledPattern)
+                if cut == 0:
+                    hardCutSize = 2 * (len(buffer) - start) # no safe chunk start so far: retry once it has doubled
+            if cut == 0:
+                scanned = max(len(buffer) - SHARD_CHECK_WINDOW, start) # later candidates still lack context
+                break
+            yield buffer[start:cut]
+            start, hardCutSize = cut, 2 * shardSize
+        buffer = buffer[start:]
+        scanned = max(scanned - start, 0)
+    buffer += "".join(pending)
+    if buffer:
+        yield buffer
+
+def countStreamChunksParallel(sources, compiledPattern, chunkCounts: dict[bytes, int], maxUniqueChunks: int, pieceSize: int, numWorkers: int, shardSize: int = CORPUS_SHARD_SIZE) -> dict[bytes, int]:
+    """
+    - Parallel version of `countStreamChunks`: the parent reads and shards the sources, workers split and count each shard, and the parent sums the partial tables.
+    - At most two shards per worker are in flight, so memory stays bounded however large the corpus is.
+    - Without pruning the reduced table equals the single-process one, so training on it yields the same merges.
+    """
+    def reduce(futures):
+        for future in futures:
+            for chunk, count in future.result().items():
+                chunkCounts[chunk] = chunkCounts.get(chunk, 0) + count
+        if maxUniqueChunks is not None and len(chunkCounts) > maxUniqueChunks:
+            pruneChunkCounts(chunkCounts, maxUniqueChunks // 2)
+
+    with ProcessPoolExecutor(max_workers=numWorkers, initializer=initChunkWorker, initargs=(compiledPattern,)) as pool:
+        pending = set()
+        for source in sources:
+            for shard in shardStream(readCorpus(source, pieceSize), compiledPattern, shardSize):
+                pending.add(pool.submit(countShardChunks, shard))
+                if len(pending) >= 2 * numWorkers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    reduce(done)
+        reduce(pending)
+    return chunkCounts
+
+###############################################################
+####################### DISPLAY HELPERS #######################
+###############################################################
+
 def replaceControlCharacters(s: str) -> str:
     # Dont print control characters which distort the output (e.g. \n or much worse)
     # Refs: https://stackoverflow.com/questions/4324790/removing-control-characters-from-a-string-in-python/19016117#19016117 & 